@@ -2,6 +2,8 @@ from importlib import import_module
 #from dataloader import MSDataLoader
 from torch.utils.data import dataloader
 from torch.utils.data import ConcatDataset
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 # This is a simple wrapper function for ConcatDataset
 class MyConcatDataset(ConcatDataset):
@@ -12,6 +14,21 @@ class MyConcatDataset(ConcatDataset):
         for d in self.datasets:
             if hasattr(d, 'set_scale'): d.set_scale(idx_scale)
 
+class ShardSampler(Sampler):
+    """
+    测试集按进程切分：rank r处理第r, r+n, r+2n...个样本（n为进程数）
+    交错切分使各进程的图像尺寸分布接近；与DistributedSampler不同，不补齐样本，
+    每个样本只计算一次，psnr求和后不会重复
+    """
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = list(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
 class Data:
     def __init__(self, args):
         """
@@ -25,7 +42,8 @@ class Data:
         """
         print('Making Dataloader...')
         self.loader_train = None
-        if not args.test_only:
+        # int8量化需要用训练数据做校准
+        if not args.test_only or args.quantize:
             # 按照数据集名称，加载对应py文件，针对性建立dataset
             # 设立不同数据集对应py文件：不同数据集的文件夹结构不同
             datasets = []
@@ -49,10 +67,16 @@ class Data:
 
 
             # 为dataset，建立dataloader
+            # DDP：每个进程只读取自己的那一份，batch_size为每个进程的batch大小
+            train_set = MyConcatDataset(datasets)
+            sampler = None
+            if args.distributed:
+                sampler = DistributedSampler(train_set, shuffle=True, seed=args.seed)
             self.loader_train = dataloader.DataLoader(
-                MyConcatDataset(datasets),
+                train_set,
                 batch_size=args.batch_size,
-                shuffle=True,
+                shuffle=(sampler is None),
+                sampler=sampler,
                 pin_memory=not args.cpu,
                 num_workers=args.n_threads,
             )
@@ -74,11 +98,16 @@ class Data:
                 m = import_module('data.' + module_name.lower())
                 testset = getattr(m, module_name)(args, train=False, name=d)
 
+            # DDP：每个进程只测试自己的那部分图像 / dat切片
+            sampler = None
+            if args.distributed:
+                sampler = ShardSampler(testset, args.world_size, args.rank)
             self.loader_test.append(
                 dataloader.DataLoader(
                     testset,
                     batch_size=1,
                     shuffle=False,
+                    sampler=sampler,
                     pin_memory=not args.cpu,
                     num_workers=args.n_threads,
                 )
@@ -1,7 +1,6 @@
 import random
 
 import numpy as np
-import skimage.color as sc
 
 import torch
 
@@ -84,6 +83,7 @@ def set_channel(*args, n_channels=3):
 
         c = img.shape[2]
         if n_channels == 1 and c == 3:
+            import skimage.color as sc
             img = np.expand_dims(sc.rgb2ycbcr(img)[:, :, 0], 2)
         elif n_channels == 3 and c == 1:
             img = np.concatenate([img] * n_channels, 2)
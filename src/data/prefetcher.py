@@ -0,0 +1,93 @@
+"""
+batch预取：在当前batch计算时，提前把下一个batch放到计算设备上
+gpu：pin_memory的batch在单独的cuda stream上non_blocking拷贝，与计算重叠
+cpu：后台线程提前从DataLoader取出并处理batch
+"""
+import threading
+from queue import Queue
+
+import torch
+
+class CUDAPrefetcher:
+    def __init__(self, loader, prepare, n_tensors=2):
+        """
+        inputs :
+            loader : DataLoader，batch为(lr, hr, filename)
+            prepare : 单个张量 -> 设备上的张量（在side stream中执行）
+            n_tensors : batch中前n_tensors个元素需要prepare，其余（文件名等）原样返回
+        """
+        self.loader = loader
+        self.prepare = prepare
+        self.n_tensors = n_tensors
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        it = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(it)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                tensors = [self.prepare(t) for t in batch[:self.n_tensors]]
+            return tensors + list(batch[self.n_tensors:])
+
+        next_batch = preload()
+        while next_batch is not None:
+            # 等待拷贝完成；张量在side stream上分配，需要登记到计算stream，防止内存被提前复用
+            current = torch.cuda.current_stream()
+            current.wait_stream(stream)
+            batch = next_batch
+            for t in batch[:self.n_tensors]:
+                t.record_stream(current)
+            next_batch = preload()
+            yield batch
+
+class ThreadPrefetcher:
+    def __init__(self, loader, prepare, n_tensors=2, depth=2):
+        self.loader = loader
+        self.prepare = prepare
+        self.n_tensors = n_tensors
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    tensors = [self.prepare(t) for t in batch[:self.n_tensors]]
+                    queue.put(tensors + list(batch[self.n_tensors:]))
+                    if stop.is_set(): return
+            except Exception as e:
+                queue.put(e)
+                return
+            queue.put(None)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None: break
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            # 提前退出循环时，让后台线程结束
+            stop.set()
+            while thread.is_alive():
+                while not queue.empty(): queue.get()
+                thread.join(timeout=0.1)
+
+def prefetch(loader, prepare, cuda, n_tensors=2):
+    if cuda:
+        return CUDAPrefetcher(loader, prepare, n_tensors=n_tensors)
+    return ThreadPrefetcher(loader, prepare, n_tensors=n_tensors)
@@ -36,6 +36,10 @@
 
 # Advanced - Training with adversarial loss
 #python main.py --template GAN --scale 4 --save edsr_gan --reset --patch_size 96 --loss 5*VGG54+0.15*GAN --pre_train download
+# Fully convolutional discriminator (PatchGAN, independent of --patch_size); use -global for global average pooling
+#python main.py --template GAN --scale 4 --save edsr_gan_patch --reset --patch_size 96 --loss 5*VGG54+0.15*GAN-patch --pre_train download
+# Keep an EMA of the weights (updated every 10 steps), evaluate with it and save model_ema.pt
+#python main.py --template HAN --save HANx2_ema --scale 2 --reset --patch_size 96 --ema_decay 0.999 --ema_eval
 
 # RDN BI model (x2)
 #python3.6 main.py --scale 2 --save RDN_D16C8G64_BIx2 --model RDN --epochs 200 --batch_size 16 --data_range 801-805 --patch_size 64 --reset
@@ -65,3 +69,15 @@
 #python main.py --template HAN --save HANx8 --scale 8 --reset --save_results --patch_size 384 --pre_train ../experiment/model/RCAN_BIX2.pt
 # Test HAN
 #python main.py --template HAN --data_test Set5+Set14+B100+Urban100+Manga109 --data_range 801-900 --scale 2 --pre_train ../experiment/HAN/HAN_BIX2.pt --test_only --save HANx2_test --save_results
+
+# Export HAN (x2) to TorchScript + ONNX, with parity check and CPU latency comparison
+#python export.py --template HAN --scale 2 --pre_train ../experiment/HAN/HAN_BIX2.pt --save HANx2_export --export_format torchscript+onnx --dynamic_axes
+# Local inference server (model loaded once, dynamic batching); query with
+# curl --data-binary @lr.png http://127.0.0.1:8000/sr -o sr.png ; curl http://127.0.0.1:8000/stats
+#python server.py --template HAN --scale 2 --chop --pre_train ../experiment/HAN/HAN_BIX2.pt --save HANx2_server --port 8000 --max_batch 8 --max_latency 10
+
+# DDP training (one process per GPU; add --cpu for gloo on CPU workers), --batch_size is per process
+#python launch.py --nproc 4 --template HAN --save HANx2_ddp --scale 2 --reset --patch_size 96 --batch_size 4
+#torchrun --nproc_per_node=4 main.py --template HAN --save HANx2_ddp --scale 2 --reset --patch_size 96 --batch_size 4
+# Sharded evaluation of the OABreast test volumes on 4 CPU workers (one merged DAT per volume)
+#python launch.py --nproc 4 --cpu --test_only --dat --template HAN --data_test Neg_07_Left_test --pre_train ../experiment/HANx2/model/model_best.pt --save HANx2_test --save_results
@@ -0,0 +1,122 @@
+"""
+将训练好的模型导出为TorchScript / ONNX，用于部署
+支持：HAN、RCAN、EDSR、RDN、MatrixModelG2
+
+用法（在src目录下运行）：
+python export.py --model HAN --scale 2 --n_colors 1 --cpu \
+    --pre_train ../experiment/xxx/model/model_best.pt \
+    --export_format torchscript+onnx --export_size 48+48 --dynamic_axes
+
+导出的只是网络本身（Model.model），forward_chop / forward_x8仍在python中完成
+两种格式都基于torch.jit.trace：EoctConv的输入输出结构在构建时确定，trace可以直接展开
+结果保存在 ../experiment/<save>/export 中，log.txt中记录：
+1、导出模型与eager模式的最大绝对误差（parity）
+2、CPU上eager / 导出模型的推理时间（中位数）
+"""
+import os
+
+from option import args
+
+import torch
+import utility
+import model
+
+supported = ('HAN', 'RCAN', 'EDSR', 'RDN', 'MatrixModelG2')
+
+def max_error(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+def export_torchscript(net, x, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(net, x)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+
+    return torch.jit.load(path)
+
+def export_onnx(net, x, path):
+    dynamic_axes = None
+    if args.dynamic_axes:
+        dynamic_axes = {
+            'lr': {0: 'batch', 2: 'height', 3: 'width'},
+            'sr': {0: 'batch', 2: 'height', 3: 'width'}
+        }
+    with torch.no_grad():
+        torch.onnx.export(
+            net, x, path,
+            opset_version=args.opset,
+            input_names=['lr'],
+            output_names=['sr'],
+            dynamic_axes=dynamic_axes
+        )
+
+    # onnxruntime是可选依赖，没有安装时只导出，不做校验
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(t):
+        return torch.from_numpy(session.run(None, {'lr': t.numpy()})[0])
+
+    return run
+
+def main():
+    # 导出与延迟测试都在cpu上进行
+    args.cpu = True
+    args.n_GPUs = 0
+    # 与--test_only、server.py相同：不改写--save目录中训练的metrics.jsonl，模型做推理化简
+    args.test_only = True
+    ckp = utility.checkpoint(args)
+    if args.model not in supported:
+        ckp.write_log('Warning: export of {} is not tested (supported: {})'.format(
+            args.model, ', '.join(supported)))
+
+    h, w = map(int, args.export_size.split('+'))
+    x = torch.rand(1, args.n_colors, h, w) * args.rgb_range
+
+    net = model.Model(args, ckp)
+    if not args.no_fuse:
+        net.fuse(ckp, [('{}x{}'.format(h, w), x)], args.rgb_range)
+    net = net.model
+    net.eval()
+    # 动态尺寸时，额外在另一个输入尺寸上校验
+    inputs = [x]
+    if args.dynamic_axes:
+        inputs.append(torch.rand(2, args.n_colors, h + 8, w + 16) * args.rgb_range)
+    with torch.no_grad():
+        refs = [net(t) for t in inputs]
+
+    dir_export = ckp.get_path('export')
+    os.makedirs(dir_export, exist_ok=True)
+    t_eager = utility.measure_latency(net, x, runs=args.export_runs)
+    ckp.write_log('[{} x{}] eager: {:.2f}ms'.format(
+        args.model, args.scale[0], t_eager * 1000))
+
+    for fmt in args.export_format.split('+'):
+        if fmt == 'torchscript':
+            path = os.path.join(dir_export, '{}_x{}.pt'.format(args.model, args.scale[0]))
+            exported = export_torchscript(net, x, path)
+        elif fmt == 'onnx':
+            path = os.path.join(dir_export, '{}_x{}.onnx'.format(args.model, args.scale[0]))
+            exported = export_onnx(net, x, path)
+        else:
+            raise ValueError('Unknown export format: {}'.format(fmt))
+
+        if exported is None:
+            ckp.write_log('{}: saved to {} (onnxruntime not found, parity check skipped)'.format(fmt, path))
+            continue
+
+        with torch.no_grad():
+            errors = [max_error(exported(t), ref) for t, ref in zip(inputs, refs)]
+        t_export = utility.measure_latency(exported, x, runs=args.export_runs)
+        ckp.write_log('{}: saved to {}\n\tmax abs error: {}\n\tlatency: {:.2f}ms ({:.2f}x eager)'.format(
+            fmt, path,
+            ', '.join('{:.2e}'.format(e) for e in errors),
+            t_export * 1000, t_eager / t_export))
+
+    ckp.done()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+DDP训练的启动入口（单机多进程）
+用法（在src目录下运行），--nproc之后的参数与main.py相同：
+python launch.py --nproc 4 --template HAN --save HANx2_ddp --scale 2 --patch_size 96
+等价于：torchrun --nproc_per_node=4 main.py ...
+
+没有gpu时加--cpu，进程之间使用gloo后端通信
+--batch_size为每个进程的batch大小，总batch为nproc * batch_size
+"""
+import os
+import sys
+import argparse
+
+# 这里不import torch：CUDA_VISIBLE_DEVICES要在torch初始化CUDA之前设置（见下面的__main__），
+# spawn出的子进程会重新import这个文件，同样不能提前import torch
+def worker(rank, nproc, argv):
+    # 进程信息通过环境变量传给option.py / utility.init_distributed
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(nproc)
+    sys.argv = ['main.py'] + argv
+
+    import main
+    main.main()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Launch DDP training')
+    parser.add_argument('--nproc', type=int, default=2,
+                        help='number of processes (one per GPU, or CPU workers with --cpu)')
+    parser.add_argument('--master_port', type=str, default='29500',
+                        help='port for the process group rendezvous')
+    launch_args, argv = parser.parse_known_args()
+
+    # 与main.py相同，--gpu_ids在import torch之前生效；子进程继承这个环境变量
+    # --gpu_ids仍留在argv中，由main.py的option解析
+    gpu_parser = argparse.ArgumentParser(add_help=False)
+    gpu_parser.add_argument('--gpu_ids', type=str, default='')
+    gpu_args, _ = gpu_parser.parse_known_args(argv)
+    if gpu_args.gpu_ids:
+        os.environ['CUDA_VISIBLE_DEVICES'] = gpu_args.gpu_ids
+
+    import torch.multiprocessing as mp
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', launch_args.master_port)
+    mp.spawn(worker, args=(launch_args.nproc, argv), nprocs=launch_args.nproc)
@@ -1,16 +1,15 @@
 import os
+from collections import OrderedDict
 from importlib import import_module
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import utility
+
 class Loss(nn.modules.loss._Loss):
     def __init__(self, args, ckp):
         super(Loss, self).__init__()
@@ -31,7 +30,10 @@ class Loss(nn.modules.loss._Loss):
                 module = import_module('loss.vgg')
                 loss_function = getattr(module, 'VGG')(
                     loss_type[3:],
-                    rgb_range=args.rgb_range
+                    rgb_range=args.rgb_range,
+                    weights=args.vgg_weights,
+                    half=args.vgg_half,
+                    channels_last=args.channels_last
                 )
             elif loss_type.find('GAN') >= 0:
                 module = import_module('loss.adversarial')
@@ -56,66 +58,132 @@ class Loss(nn.modules.loss._Loss):
                 print('{:.3f} * {}'.format(l['weight'], l['type']))
                 self.loss_module.append(l['function'])
 
-        # loss log，为文件loss.pt做准备
-        self.log = torch.Tensor()
+        # loss log：每个epoch一行（各loss的平均值），同时追加到ckp的metrics.jsonl
+        self.log = []
+        self.metrics = ckp.metrics
         # 创建设备对象，为tensor的计算做准备
         device = torch.device('cpu' if args.cpu else 'cuda')
+        self.device = device
         self.loss_module.to(device)
         if args.precision == 'half': self.loss_module.half()
+        # DDP：判别器与生成器一样在进程之间同步梯度（见Adversarial.distribute）
+        if args.distributed:
+            for l in self.loss:
+                if l['type'].find('GAN') >= 0:
+                    l['function'].distribute(None if args.cpu else [args.local_rank])
+
+        # --loss表达式在这里解析一次：
+        # pixel：L1/MSE，共用一个sr - hr，在pixel_loss中一起计算
+        # terms：其他带模块的loss（VGG、GAN），逐个调用
+        # dis：判别器loss，只记录
+        self.pixel = [(i, l['type']) for i, l in enumerate(self.loss) if l['type'] in ('L1', 'MSE')]
+        self.terms = [i for i, l in enumerate(self.loss)
+                      if l['function'] is not None and l['type'] not in ('L1', 'MSE')]
+        self.dis = [i for i, l in enumerate(self.loss) if l['type'] == 'DIS']
+
+        # 编译pixel loss（训练尺寸固定）
+        # VGG loss不编译：各VGG loss共享的trunk按输入张量的id查找中间特征、forward中计时，
+        # 在dynamo中会graph break或重新编译；adversarial在forward中更新判别器，也不编译
+        if args.compile:
+            self.pixel_loss = torch.compile(self.pixel_loss, mode=args.compile_mode, dynamic=False)
 
         #
         # if not args.cpu and args.n_GPUs > 1:
         #     self.loss_module = nn.DataParallel(
         #         self.loss_module, range(args.n_GPUs)
         #     )
-        if not args.cpu and args.n_GPUs > 0:
+        # 单卡不需要DataParallel；DDP时每个进程只有一个设备，DataParallel会把模块移到cuda:0
+        if not args.cpu and args.n_GPUs > 1 and not args.distributed:
             self.loss_module = nn.DataParallel(
                 self.loss_module, range(args.n_GPUs)
             )
 
         # load非空，加载上一次训练的loss参数
-        if args.load != '': self.load(ckp.dir, cpu=args.cpu)
+        if args.load != '': self.load(ckp.dir, cpu=args.cpu, state=ckp.load_state())
 
     # 函数组1
-    def load(self, apath, cpu=False):
+    def load(self, apath, cpu=False, state=None):
         if cpu:
             kwargs = {'map_location': lambda storage, loc: storage}
         else:
             kwargs = {}
 
-        # 加载上次训练的loss权重
-        self.load_state_dict(torch.load(
-            os.path.join(apath, 'loss.pt'),
-            **kwargs
-        ))
-        # 加载上次训练中每个epoch的loss
-        self.log = torch.load(os.path.join(apath, 'loss_log.pt'))
-        # 没搞懂
+        # 加载上次训练的loss权重：checkpoint.pt中的loss部分，旧实验为loss.pt
+        # 以前单卡时loss_module也包了一层DataParallel，key多一个module.，按当前结构转换
+        epoch = None
+        if state is not None:
+            epoch = state['epoch']
+            state = state['loss']
+        else:
+            state = torch.load(os.path.join(apath, 'loss.pt'), **kwargs)
+        wrapped = isinstance(self.loss_module, nn.DataParallel)
+        prefix, prefix_dp = 'loss_module.', 'loss_module.module.'
+        converted = {}
+        for k, v in state.items():
+            if wrapped and k.startswith(prefix) and not k.startswith(prefix_dp):
+                k = prefix_dp + k[len(prefix):]
+            elif not wrapped and k.startswith(prefix_dp):
+                k = prefix + k[len(prefix_dp):]
+            converted[k] = v
+        self.load_state_dict(converted)
+        # 加载上次训练中每个epoch的loss：按epoch分组metrics.jsonl中的loss记录
+        rows = OrderedDict()
+        for r in self.metrics.records:
+            if 'loss' in r: rows.setdefault(r['epoch'], {})[r['loss']] = r['value']
+        if not rows and os.path.exists(os.path.join(apath, 'loss_log.pt')):
+            # 旧实验只有loss_log.pt，转换一次
+            log = torch.load(os.path.join(apath, 'loss_log.pt'))
+            for i, row in enumerate(log):
+                rows[i + 1] = {l['type']: v.item() for l, v in zip(self.loss, row)}
+                self.metrics.append(self._records(i + 1, row))
+        self.log = [
+            torch.tensor([row.get(l['type'], 0.0) for l in self.loss]) for row in rows.values()
+        ]
+        # 判别器的scheduler按已训练的epoch数重放：有checkpoint.pt时用其中的epoch，
+        # 旧实验用loss记录的epoch数
+        if epoch is None: epoch = len(self.log)
         for l in self.get_loss_module():
             if hasattr(l, 'scheduler'):
-                for _ in range(len(self.log)): l.scheduler.step()
+                for _ in range(epoch): l.scheduler.step()
 
     def get_loss_module(self):
-        if self.n_GPUs == 1:
-            return self.loss_module
-        else:
+        if isinstance(self.loss_module, nn.DataParallel):
             return self.loss_module.module
+        else:
+            return self.loss_module
 
     # 函数组2
-    def save(self, apath):
-        torch.save(self.state_dict(), os.path.join(apath, 'loss.pt'))
-        torch.save(self.log, os.path.join(apath, 'loss_log.pt'))
+    def save(self, apath, writer=None):
+        save = utility.save_atomic if writer is None else writer.save
+        save(self.state_dict(), os.path.join(apath, 'loss.pt'))
+
+    def _records(self, epoch, row):
+        return [{'epoch': epoch, 'loss': l['type'], 'value': v.item()}
+                for l, v in zip(self.loss, row)]
 
     # 函数组3
     def start_log(self):
-        # 为什么是1, len(self.loss)：一次记录，有几个loss函数，就有几个对应的loss函数值
-        # 默认在第一个维度上，进行拼接
-        # 这一个epoch，记录loss做准备
-        self.log = torch.cat((self.log, torch.zeros(1, len(self.loss))))
+        # 一次记录，有几个loss函数，就有几个对应的loss函数值
+        # 这一个epoch，记录loss做准备（list追加，不再torch.cat整个历史）
+        self.log.append(torch.zeros(len(self.loss)))
+        # 每个batch的loss在设备上累加，不逐个batch调用.item()同步
+        self.log_acc = torch.zeros(len(self.loss), device=self.device)
+
+    def vgg_time(self):
+        # VGG loss自上次调用以来所用的时间（秒），没有VGG loss时为None
+        times = [l['function'].pop_time() for l in self.loss
+                 if l['type'].find('VGG') >= 0]
+        return sum(times) if times else None
+
+    def sync_log(self):
+        # 只在print_every和end_log时，把设备上的累加值拷贝到self.log
+        self.log[-1] = self.log_acc.cpu()
 
     def end_log(self, n_batches):
         # 累加epoch中每个batch的loss值，最后求平均值
+        self.sync_log()
         self.log[-1].div_(n_batches)
+        self.metrics.append(self._records(len(self.log), self.log[-1]))
 
     # 函数组4
     def display_loss(self, batch):
@@ -125,6 +193,7 @@ class Loss(nn.modules.loss._Loss):
         :return:
         """
         n_samples = batch + 1
+        self.sync_log()
         log = []
         for l, c in zip(self.loss, self.log[-1]):
             # c / n_samples：loss当前平均值
@@ -133,28 +202,19 @@ class Loss(nn.modules.loss._Loss):
         # 将log中的元素拼接成字符串
         return ''.join(log)
 
-    def plot_loss(self, apath, epoch):
-        # 等差数列：start：1   end：epoch   num：epoch
-        axis = np.linspace(1, epoch, epoch)
+    def plot_loss(self, apath, epoch, writer=None):
+        # 等差数列：start：1   end：len(self.log)
+        axis = np.arange(1, len(self.log) + 1)
+        log = torch.stack(self.log).numpy()
         for i, l in enumerate(self.loss):
             label = '{} Loss'.format(l['type'])
-            # 创建Figure对象
-            fig = plt.figure()
-            plt.title(label)
-            # self.log[:, i] self.loss中第i个loss函数在各个epoch的loss平均值
-            # X轴：axis   Y轴：self.log[:, i]
-            # self.log[:, i].numpy() 将tensor转ndarray
-            # label：线条的标签
-            plt.plot(axis, self.log[:, i].numpy(), label=label)
-            # legeng：（图表上的）图例，说明
-            # 将plt.plot中指定的label，添加进图例中；图例解释了”线条颜色与label“的对应关系
-            plt.legend()
-            plt.xlabel('Epochs')
-            plt.ylabel('Loss')
-            plt.grid(True)
-            # 以pdf的形式形式保存图片
-            plt.savefig(os.path.join(apath, 'loss_{}.png'.format(l['type'])))
-            plt.close(fig)
+            # log[:, i] self.loss中第i个loss函数在各个epoch的loss平均值，拷贝一份交给后台线程绘制
+            args = (os.path.join(apath, 'loss_{}.png'.format(l['type'])),
+                    label, [(label, axis, log[:, i].copy())], 'Loss')
+            if writer is None:
+                utility.plot_curves(*args)
+            else:
+                writer.submit(utility.plot_curves, *args)
 
     # 函数组5
     def forward(self, sr, hr):
@@ -166,26 +226,33 @@ class Loss(nn.modules.loss._Loss):
         :param hr:
         :return:
         """
-        losses = []
-        for i, l in enumerate(self.loss):
-            if l['function'] is not None:
-                loss = l['function'](sr, hr)
+        losses = {}
+        if self.pixel:
+            for (i, _), loss in zip(self.pixel, self.pixel_loss(sr, hr)):
+                losses[i] = loss
+        for i in self.terms:
+            losses[i] = self.loss[i]['function'](sr, hr)
+
+        # 按--loss中的顺序加权求和，与原来逐项相加的结果一致
+        loss_sum = 0
+        for i in sorted(losses):
+            effective_loss = self.loss[i]['weight'] * losses[i]
+            loss_sum = loss_sum + effective_loss
+            # 累加loss，为之后求平均值做准备
+            self.log_acc[i] += effective_loss.detach()
+        for i in self.dis:
+            self.log_acc[i] += self.loss[i - 1]['function'].loss
 
-                # print(f"forward {l['type']} : {loss}")
-
-                effective_loss = l['weight'] * loss
-                losses.append(effective_loss)
-                # 累加loss，为之后求平均值做准备
-                self.log[-1, i] += effective_loss.item()
-            elif l['type'] == 'DIS':
-                self.log[-1, i] += self.loss[i - 1]['function'].loss
-
-        loss_sum = sum(losses)
         if len(self.loss) > 1:
-            self.log[-1, -1] += loss_sum.item()
+            self.log_acc[-1] += loss_sum.detach()
 
         return loss_sum
 
+    def pixel_loss(self, sr, hr):
+        # L1、MSE共用一个差值，与nn.L1Loss/nn.MSELoss（mean）的结果相同
+        diff = sr - hr
+        return [diff.abs().mean() if t == 'L1' else diff.pow(2).mean() for _, t in self.pixel]
+
     def step(self):
         # 多个loss函数
         # for l in self.get_loss_module():
@@ -1,5 +1,6 @@
 import utility
 from types import SimpleNamespace
+from contextlib import nullcontext
 
 from model import common
 from loss import discriminator
@@ -12,9 +13,11 @@ import torch.optim as optim
 class Adversarial(nn.Module):
     def __init__(self, args, gan_type):
         super(Adversarial, self).__init__()
+        # gan_type可以带判别器类型后缀：GAN-patch、WGAN_GP-global等
+        gan_type, _, d_type = gan_type.partition('-')
         self.gan_type = gan_type
         self.gan_k = args.gan_k
-        self.dis = discriminator.Discriminator(args)
+        self.dis = discriminator.Discriminator(args, d_type=d_type or 'linear')
         if gan_type == 'WGAN_GP':
             # see https://arxiv.org/pdf/1704.00028.pdf pp.4
             optim_dict = {
@@ -31,44 +34,78 @@ class Adversarial(nn.Module):
             optim_args = args
 
         self.optimizer = utility.make_optimizer(optim_args, self.dis)
+        # 判别器实际调用的函数，DDP时由distribute替换
+        self.forward_dis = self.dis.__call__
+        self.no_sync = nullcontext
+        self.sync_grads = False
+
+    def distribute(self, device_ids=None):
+        """
+        DDP：判别器的梯度也在进程之间同步，否则每个进程训练各自的判别器
+        在Loss把模块移到设备上之后调用；包装后的模块不注册为子模块，state_dict的key不变
+        生成器更新时的判别器forward放在no_sync中：这部分判别器梯度在下一次判别器更新前会被清零，不需要同步
+        WGAN_GP的梯度惩罚经过判别器求二阶导（autograd.grad(create_graph=True)），DDP不支持：
+        这时不包装，判别器的参数、buffer先以rank 0为准，每次判别器更新前手动对梯度取平均
+        """
+        if self.gan_type == 'WGAN_GP':
+            with torch.no_grad():
+                utility.broadcast_tensors_(list(self.dis.state_dict().values()))
+            self.sync_grads = True
+            return
+
+        ddp = nn.parallel.DistributedDataParallel(self.dis, device_ids=device_ids)
+        self.forward_dis = ddp.__call__
+        self.no_sync = ddp.no_sync
 
     def forward(self, fake, real):
+        """
+        判别器更新时，fake、real（WGAN_GP还有插值样本hat）拼接成一个batch，只调用一次self.dis
+        注意：判别器中的BatchNorm因此使用拼接后batch的统计量
+        生成器更新时不再重新计算real的logits：使用最后一次判别器更新中的d_real（detach），
+        RGAN不再需要retain_graph
+        """
         # updating discriminator...
         self.loss = 0
         fake_detach = fake.detach()     # do not backpropagate through G
+        n = fake.size(0)
+        gp = self.gan_type == 'WGAN_GP'
         for _ in range(self.gan_k):
             self.optimizer.zero_grad()
+            inputs = [fake_detach, real]
+            if gp:
+                # see https://arxiv.org/pdf/1704.00028.pdf pp.4，每个样本一个epsilon
+                epsilon = torch.rand(n, 1, 1, 1, device=fake.device, dtype=fake.dtype)
+                hat = torch.lerp(fake_detach, real.detach(), epsilon).requires_grad_(True)
+                inputs.append(hat)
             # d: B x 1 tensor
-            d_fake = self.dis(fake_detach)
-            d_real = self.dis(real)
-            retain_graph = False
+            d = self.forward_dis(torch.cat(inputs))
+            d_fake, d_real = d[:n], d[n:2 * n]
             if self.gan_type == 'GAN':
                 loss_d = self.bce(d_real, d_fake)
             elif self.gan_type.find('WGAN') >= 0:
                 loss_d = (d_fake - d_real).mean()
-                if self.gan_type.find('GP') >= 0:
-                    epsilon = torch.rand_like(fake).view(-1, 1, 1, 1)
-                    hat = fake_detach.mul(1 - epsilon) + real.mul(epsilon)
-                    hat.requires_grad = True
-                    d_hat = self.dis(hat)
+                if gp:
+                    d_hat = d[2 * n:]
+                    # create_graph=True时计算图会保留，不需要retain_graph
                     gradients = torch.autograd.grad(
                         outputs=d_hat.sum(), inputs=hat,
-                        retain_graph=True, create_graph=True, only_inputs=True
+                        create_graph=True, only_inputs=True
                     )[0]
-                    gradients = gradients.view(gradients.size(0), -1)
-                    gradient_norm = gradients.norm(2, dim=1)
+                    gradient_norm = gradients.flatten(1).norm(2, dim=1)
                     gradient_penalty = 10 * gradient_norm.sub(1).pow(2).mean()
-                    loss_d += gradient_penalty
+                    loss_d = loss_d + gradient_penalty
             # from ESRGAN: Enhanced Super-Resolution Generative Adversarial Networks
             elif self.gan_type == 'RGAN':
                 better_real = d_real - d_fake.mean(dim=0, keepdim=True)
                 better_fake = d_fake - d_real.mean(dim=0, keepdim=True)
                 loss_d = self.bce(better_real, better_fake)
-                retain_graph = True
 
             # Discriminator update
-            self.loss += loss_d.item()
-            loss_d.backward(retain_graph=retain_graph)
+            # 不调用.item()：保持在设备上（float64累加，与原来python float的结果一致），由Loss统一同步
+            self.loss += loss_d.detach().double()
+            loss_d.backward()
+            if self.sync_grads:
+                utility.all_reduce_mean_([p.grad for p in self.dis.parameters() if p.grad is not None])
             self.optimizer.step()
 
             if self.gan_type == 'WGAN':
@@ -78,13 +115,16 @@ class Adversarial(nn.Module):
         self.loss /= self.gan_k
 
         # updating generator...
-        d_fake_bp = self.dis(fake)      # for backpropagation, use fake as it is
+        with self.no_sync():
+            d_fake_bp = self.forward_dis(fake)      # for backpropagation, use fake as it is
         if self.gan_type == 'GAN':
             label_real = torch.ones_like(d_fake_bp)
             loss_g = F.binary_cross_entropy_with_logits(d_fake_bp, label_real)
         elif self.gan_type.find('WGAN') >= 0:
             loss_g = -d_fake_bp.mean()
         elif self.gan_type == 'RGAN':
+            # d_real与生成器无关，detach后复用
+            d_real = d_real.detach()
             better_real = d_real - d_fake_bp.mean(dim=0, keepdim=True)
             better_fake = d_fake_bp - d_real.mean(dim=0, keepdim=True)
             loss_g = self.bce(better_fake, better_real)
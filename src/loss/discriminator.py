@@ -5,9 +5,15 @@ import torch.nn as nn
 class Discriminator(nn.Module):
     '''
         output is not normalized
+        d_type（--loss中GAN类型的后缀，如0.005*RGAN-patch）：
+            linear : 原结构，Linear的输入大小由patch_size决定（默认）
+            patch  : 全卷积PatchGAN，每个感受野输出一个logit，B x N
+            global : 全局平均池化后接Linear，参数量与输入尺寸无关
+        patch/global可以对任意尺寸（包括测试图像）打分
     '''
-    def __init__(self, args):
+    def __init__(self, args, d_type='linear'):
         super(Discriminator, self).__init__()
+        self.d_type = d_type
 
         in_channels = args.n_colors
         out_channels = 64
@@ -37,19 +43,36 @@ class Discriminator(nn.Module):
                 stride = 2
             m_features.append(_block(in_channels, out_channels, stride=stride))
 
-        patch_size = args.patch_size // (2**((depth + 1) // 2))
-        m_classifier = [
-            nn.Linear(out_channels * patch_size**2, 1024),
-            nn.LeakyReLU(negative_slope=0.2, inplace=True),
-            nn.Linear(1024, 1)
-        ]
+        if d_type == 'linear':
+            patch_size = args.patch_size // (2**((depth + 1) // 2))
+            m_classifier = [
+                nn.Linear(out_channels * patch_size**2, 1024),
+                nn.LeakyReLU(negative_slope=0.2, inplace=True),
+                nn.Linear(1024, 1)
+            ]
+        elif d_type == 'patch':
+            m_classifier = [nn.Conv2d(out_channels, 1, 3, padding=1)]
+        elif d_type == 'global':
+            m_classifier = [
+                nn.AdaptiveAvgPool2d(1),
+                nn.Flatten(),
+                nn.Linear(out_channels, 1024),
+                nn.LeakyReLU(negative_slope=0.2, inplace=True),
+                nn.Linear(1024, 1)
+            ]
+        else:
+            raise ValueError('Unknown discriminator type: {}'.format(d_type))
 
         self.features = nn.Sequential(*m_features)
         self.classifier = nn.Sequential(*m_classifier)
 
     def forward(self, x):
         features = self.features(x)
-        output = self.classifier(features.view(features.size(0), -1))
+        if self.d_type == 'linear':
+            output = self.classifier(features.view(features.size(0), -1))
+        else:
+            # patch: B x 1 x h x w -> B x (h*w)；global: B x 1
+            output = self.classifier(features).flatten(1)
 
         return output
 
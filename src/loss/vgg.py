@@ -1,19 +1,71 @@
 from model import common
 
+import time
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
 
+"""
+同一个权重文件只加载一次vgg19：--loss中同时有VGG22和VGG54时，
+两个loss的self.vgg由同一组卷积层对象组成（state_dict的key与原来相同），
+sr/hr在前8层的特征只计算一次，VGG54从VGG22的输出处继续计算
+"""
+_trunks = {}
+
+def _load_vgg19(weights):
+    """
+    weights为空：torchvision下载预训练权重（需要网络）
+    weights为本地路径：离线加载，可以是完整vgg19的state_dict，也可以只有features部分
+    """
+    if not weights:
+        return models.vgg19(pretrained=True).features
+
+    vgg = models.vgg19()
+    state = torch.load(weights, map_location='cpu')
+    if any(k.startswith('features.') for k in state):
+        state = {k[len('features.'):]: v for k, v in state.items() if k.startswith('features.')}
+    vgg.features.load_state_dict(state)
+
+    return vgg.features
+
+class _Trunk:
+    """各VGG loss共享的卷积层，以及当前batch的中间特征"""
+    def __init__(self, weights):
+        self.modules = [m for m in _load_vgg19(weights)]
+        self.taps = set()
+        self.users = 0
+        # [(输入张量, {层数: 特征}, 已使用次数)]，所有VGG loss都用过之后删除
+        self.cache = []
+
+    def register(self, depth):
+        self.taps.add(depth)
+        self.users += 1
+        # 其他loss会从这一层的输出继续计算，之后的relu不能原地修改它
+        if depth < len(self.modules) and isinstance(self.modules[depth], nn.ReLU):
+            self.modules[depth].inplace = False
+
+    def lookup(self, x):
+        for entry in self.cache:
+            if entry[0] is x: return entry
+        return None
+
 class VGG(nn.Module):
-    def __init__(self, conv_index, rgb_range=1):
+    def __init__(self, conv_index, rgb_range=1, weights='', half=False, channels_last=False):
         super(VGG, self).__init__()
-        vgg_features = models.vgg19(pretrained=True).features
-        modules = [m for m in vgg_features]
+        if weights not in _trunks:
+            _trunks[weights] = _Trunk(weights)
+        self.trunk = _trunks[weights]
+
         if conv_index.find('22') >= 0:
-            self.vgg = nn.Sequential(*modules[:8])
+            self.depth = 8
         elif conv_index.find('54') >= 0:
-            self.vgg = nn.Sequential(*modules[:35])
+            self.depth = 35
+        self.vgg = nn.Sequential(*self.trunk.modules[:self.depth])
+        self.trunk.register(self.depth)
+        if channels_last:
+            self.vgg.to(memory_format=torch.channels_last)
 
         vgg_mean = (0.485, 0.456, 0.406)
         vgg_std = (0.229 * rgb_range, 0.224 * rgb_range, 0.225 * rgb_range)
@@ -21,16 +73,63 @@ class VGG(nn.Module):
         for p in self.parameters():
             p.requires_grad = False
 
+        self.half = half
+        # 计时：gpu上用cuda event记录，读取时才同步
+        self.events = []
+        self.elapsed = 0
+
+    def _features(self, x):
+        trunk = self.trunk
+        entry = trunk.lookup(x)
+        if entry is None:
+            entry = [x, {}, 0]
+            # 只保留当前batch的sr、hr
+            del trunk.cache[:-1]
+            trunk.cache.append(entry)
+        feats = entry[1]
+
+        if self.depth not in feats:
+            # 从已经算过的最深一层继续
+            start = max([d for d in feats if d < self.depth], default=0)
+            h = feats[start] if start > 0 else self.sub_mean(x)
+            for i in range(start, self.depth):
+                h = self.vgg[i](h)
+                if i + 1 in trunk.taps: feats[i + 1] = h
+
+        entry[2] += 1
+        if entry[2] >= trunk.users:
+            trunk.cache.remove(entry)
+
+        return feats[self.depth]
+
     def forward(self, sr, hr):
-        def _forward(x):
-            x = self.sub_mean(x)
-            x = self.vgg(x)
-            return x
-            
-        vgg_sr = _forward(sr)
-        with torch.no_grad():
-            vgg_hr = _forward(hr.detach())
+        if sr.is_cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            t0 = time.time()
 
-        loss = F.mse_loss(vgg_sr, vgg_hr)
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.half and sr.is_cuda):
+            vgg_sr = self._features(sr)
+            with torch.no_grad():
+                vgg_hr = self._features(hr)
+
+        loss = F.mse_loss(vgg_sr.float(), vgg_hr.float()).to(sr.dtype)
+
+        if sr.is_cuda:
+            end.record()
+            self.events.append((start, end))
+        else:
+            self.elapsed += time.time() - t0
 
         return loss
+
+    def pop_time(self):
+        # 自上次调用以来，VGG loss（前向）所用的时间（秒）
+        for start, end in self.events:
+            end.synchronize()
+            self.elapsed += start.elapsed_time(end) / 1000
+        self.events = []
+        elapsed, self.elapsed = self.elapsed, 0
+
+        return elapsed
@@ -1,9 +1,18 @@
+import time
+t_start = time.time()
+
+import os
+from option import args
+
+# 必须在CUDA初始化之前设置
+if args.gpu_ids:
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_ids
+
 import torch
 import utility
 import data
 import model
 import loss
-from option import args
 from trainer import Trainer
 import gc
 
@@ -16,6 +25,8 @@ torch.cuda.empty_cache()
 目的：方便复现
 """
 torch.manual_seed(args.seed)
+# DDP（torchrun / launch.py启动）：初始化进程组，checkpoint只在rank 0写文件
+utility.init_distributed(args)
 checkpoint = utility.checkpoint(args)
 
 def main():
@@ -32,6 +43,7 @@ def main():
             _model = model.Model(args, checkpoint)
             _loss = loss.Loss(args, checkpoint) if not args.test_only else None
             t = Trainer(args, loader, _model, _loss, checkpoint)
+            checkpoint.write_log('Startup: {:.2f}s'.format(time.time() - t_start))
             while not t.terminate():
                 t.train()
                 t.test()
@@ -1,11 +1,33 @@
 import os
+import copy
 from importlib import import_module
 
 import torch
 import torch.nn as nn
 import torch.nn.parallel as P
 import torch.utils.model_zoo
-os.environ["CUDA_VISIBLE_DEVICES"] = '0,1'
+
+"""
+模型注册表：--model名称（小写） -> (模块路径, 构造函数名)
+只导入被选中模型所在的模块，其他模型（及其依赖，如dcn扩展）不会在启动时加载
+未注册的名称按原来的约定，导入model.<name>并调用make_model
+"""
+_registry = {}
+
+def register(name, module, factory='make_model'):
+    _registry[name.lower()] = (module, factory)
+
+for _name in ('DDBPN', 'EDSR', 'HAN', 'MDSR', 'RCAN', 'RCAN1', 'RCAN3', 'RCAN4',
+              'RDN', 'RDN1', 'RDN2', 'VDSR', 'MatrixModel'):
+    register(_name, 'model.' + _name.lower())
+for _name in ('MatrixModelB', 'MatrixModelC', 'MatrixModelD', 'MatrixModelE', 'MatrixModelF',
+              'MatrixModelF2', 'MatrixModelG', 'MatrixModelG2', 'MatrixModelH'):
+    register(_name, 'model.matrixmodel', _name)
+
+def make_model(args):
+    name = args.model.lower()
+    module, factory = _registry.get(name, ('model.' + name, 'make_model'))
+    return getattr(import_module(module), factory)(args)
 
 class Model(nn.Module):
     # 函数组1
@@ -21,17 +43,22 @@ class Model(nn.Module):
         self.chop = args.chop
         self.precision = args.precision
         self.cpu = args.cpu
+        self.channels_last = args.channels_last
+        self.distributed = args.distributed
+        self.local_rank = args.local_rank
         self.device = torch.device('cpu' if args.cpu else 'cuda')
         self.n_GPUs = args.n_GPUs
         self.save_models = args.save_models
 
-        module = import_module('model.' + args.model.lower())
         """
         Modle对象有model属性
         Model对象有forword函数
         Model.modle也有forword函数
         """
-        self.model = module.make_model(args).to(self.device)
+        self.model = make_model(args).to(self.device)
+        if args.channels_last:
+            # gpu上使用cudnn的NHWC卷积，cpu上使用oneDNN（mkldnn）的NHWC卷积
+            self.model = self.model.to(memory_format=torch.channels_last)
         if args.precision == 'half':
             self.model.half()
 
@@ -39,7 +66,8 @@ class Model(nn.Module):
             ckp.get_path('model'),
             pre_train=args.pre_train,
             resume=args.resume,
-            cpu=args.cpu
+            cpu=args.cpu,
+            state=ckp.load_state() if args.resume == -1 else None
         )
         """
         将self.model，输出到ckp.log_file，也就是log.txt
@@ -49,17 +77,63 @@ class Model(nn.Module):
         """
         print(self.model, file=ckp.log_file)
 
-    def load(self, apath, pre_train='', resume=-1, cpu=False):
+        # --test_only时的Conv+BN、MeanShift合并（fuse）在Trainer中进行，需要测试集的图像
+        self.set_forward(args.compile, args.compile_mode)
+
+    def set_forward(self, compile=False, mode='default'):
+        """
+        训练/测试时实际调用的函数在这里确定一次，forward中不再逐次判断
+        compile=True时（单卡）：
+        1、训练：patch尺寸固定，dynamic=False，只针对训练尺寸编译一次
+        2、测试：图像尺寸不固定，dynamic=True，避免每个尺寸都重新编译
+        编译的是self.model.forward（函数），不是模块，state_dict的key不变
+        HAN的LAM/CSAM中reshape的尺寸来自x.size()，不会打断graph；
+        MatrixModel中octave分支的tuple可能产生graph break，这部分退回eager执行
+        self.model被替换后（如int8量化）需要重新调用
+        DDP时训练经过DistributedDataParallel（梯度在backward中同步），测试直接使用self.model
+        self.model的set_scale也在这里取一次（han模型没有set_scale函数，为None）
+        """
+        self.set_scale = getattr(self.model, 'set_scale', None)
+        self.forward_args = (compile, mode)
+
+        if self.distributed and any(p.requires_grad for p in self.model.parameters()):
+            ddp = nn.parallel.DistributedDataParallel(
+                self.model,
+                device_ids=None if self.cpu else [self.local_rank]
+            )
+            if compile:
+                self.forward_train = torch.compile(ddp, mode=mode, dynamic=False).__call__
+            else:
+                self.forward_train = ddp.__call__
+        elif self.n_GPUs > 1:
+            self.forward_train = lambda x: P.data_parallel(self.model, x, range(self.n_GPUs))
+        elif compile:
+            self.forward_train = torch.compile(self.model.forward, mode=mode, dynamic=False)
+        else:
+            self.forward_train = self.model.__call__
+
+        if compile and self.n_GPUs <= 1:
+            self.forward_test = torch.compile(self.model.forward, mode=mode, dynamic=True)
+        else:
+            self.forward_test = self.model.forward
+
+    def load(self, apath, pre_train='', resume=-1, cpu=False, state=None):
+        """
+        state：续训时checkpoint.pt的内容（mmap），旧实验没有时读取model_latest.pt
+        本地的权重文件都用utility.load_checkpoint加载：先mmap到cpu，
+        load_state_dict时直接拷贝到模型所在的设备
+        """
+        import utility
         load_from = None
         kwargs = {}
         if cpu:
             kwargs = {'map_location': lambda storage, loc: storage}
 
         if resume == -1:
-            load_from = torch.load(
-                os.path.join(apath, 'model_latest.pt'),
-                **kwargs
-            )
+            if state is not None:
+                load_from = state['model']
+            else:
+                load_from = utility.load_checkpoint(os.path.join(apath, 'model_latest.pt'))
         elif resume == 0:
             if pre_train == 'download':
                 print('Download the model')
@@ -72,42 +146,81 @@ class Model(nn.Module):
                 )
             elif pre_train:
                 print('Load the model from {}'.format(pre_train))
-                load_from = torch.load(pre_train, **kwargs)
+                load_from = utility.load_checkpoint(pre_train)
+                # 也可以直接使用另一个实验的checkpoint.pt
+                if 'version' in load_from and 'model' in load_from:
+                    load_from = load_from['model']
         else:
-            load_from = torch.load(
-                os.path.join(apath, 'model_{}.pt'.format(resume)),
-                **kwargs
+            load_from = utility.load_checkpoint(
+                os.path.join(apath, 'model_{}.pt'.format(resume))
             )
 
         if load_from:
             self.model.load_state_dict(load_from, strict=False)
 
+    def fuse(self, ckp, inputs, rgb_range, tol=1e-3, runs=3):
+        """
+        对self.model做推理化简（见model/fuse.py），化简后重新set_forward
+        inputs : [(名称, lr)]，如各测试集的第一张图像（cpu上的张量即可，这里转换到模型的设备、精度）
+        1、在inputs[0]上校验：最大误差超过tol * rgb_range时放弃化简，使用原模型
+        2、在每个输入上测量化简前后的推理时间（与test相同，经过forward_chop / forward_x8），写入log
+        原模型只在cpu上保留一份（放弃化简时恢复），不在gpu上多占一份模型
+        """
+        import utility
+        from model.fuse import fuse_for_inference
+
+        self.eval()
+        p = next(self.model.parameters())
+        device, dtype = p.device, p.dtype
+        xs = []
+        for name, x in inputs:
+            x = x.to(device, dtype)
+            if self.channels_last: x = x.contiguous(memory_format=torch.channels_last)
+            xs.append((name, x))
+
+        # 计时不包括torch.compile的编译，两次都直接调用self.model.forward
+        self.forward_test = self.model.forward
+        forward = lambda x: self(x, 0)
+        with torch.no_grad():
+            reference = forward(xs[0][1])
+        t_before = [utility.measure_latency(forward, x, runs=runs, warmup=1) for _, x in xs]
+        backup = copy.deepcopy(self.model.cpu())
+        self.model.to(device)
+
+        fused = fuse_for_inference(self.model)
+        self.forward_test = self.model.forward
+        with torch.no_grad():
+            error = (forward(xs[0][1]) - reference).abs().max().item()
+        del reference
+        if error > tol * rgb_range:
+            self.model = backup.to(device)
+            ckp.write_log('Inference fusion ({}) rejected: max error {:.2e}'.format(fused, error))
+        else:
+            t_after = [utility.measure_latency(forward, x, runs=runs, warmup=1) for _, x in xs]
+            ckp.write_log('Inference fusion ({}): max error {:.2e}'.format(fused, error))
+            for (name, _), t0, t1 in zip(xs, t_before, t_after):
+                ckp.write_log('[{}] {:.2f}ms -> {:.2f}ms ({:.2f}x)'.format(
+                    name, t0 * 1000, t1 * 1000, t0 / max(t1, 1e-8)))
+        del backup
+
+        self.set_forward(*self.forward_args)
+
     # 函数组2
     def forward(self, x, idx_scale):
         self.idx_scale = idx_scale
         """
         han模型没有set_scale函数
         """
-        if hasattr(self.model, 'set_scale'):
-            self.model.set_scale(idx_scale)
+        if self.set_scale is not None:
+            self.set_scale(idx_scale)
 
         """
         self.training在这个文件中第一次出现
         ？在调用处指明
         """
         if self.training:
-            if self.n_GPUs > 1:
-                """
-                多gpu处理
-                
-                loss模块中也有对应的多gpu处理
-                """
-                return P.data_parallel(self.model, x, range(self.n_GPUs))
-            else:
-                """
-                调用model.forward函数
-                """
-                return self.model(x)
+            # 多gpu：data_parallel；单卡：self.model或其编译结果，见set_forward
+            return self.forward_train(x)
         else:
             """
             HAN　template　默认
@@ -117,7 +230,7 @@ class Model(nn.Module):
             if self.chop:
                 forward_function = self.forward_chop
             else:
-                forward_function = self.model.forward
+                forward_function = self.forward_test
 
             if self.self_ensemble:
                 return self.forward_x8(x, forward_function=forward_function)
@@ -140,7 +253,7 @@ class Model(nn.Module):
             sr_list = []
             for i in range(0, 4, n_GPUs):
                 lr_batch = torch.cat(lr_list[i:(i + n_GPUs)], dim=0)
-                sr_batch = self.model(lr_batch)
+                sr_batch = self.forward_test(lr_batch)
                 sr_list.extend(sr_batch.chunk(n_GPUs, dim=0))
         else:
             sr_list = [
@@ -213,13 +326,16 @@ class Model(nn.Module):
         return y
 
     # 函数组3
-    def save(self, apath, epoch, is_best=False):
+    def save(self, apath, epoch, is_best=False, writer=None, state_dict=None):
         """
         checkpoint的save函数调用，统一保存各种信息
         视情况，最多保存三种类型的模型参数文件
         :param apath:
         :param epoch:
         :param is_best:
+        :param writer: utility.BackgroundWriter，为None时在当前线程写入
+        :param state_dict: 已经做过cpu快照的模型权重（checkpoint.save中与checkpoint.pt共用），
+            为None时从self.model取
         :return:
         """
         save_dirs = [os.path.join(apath, 'model_latest.pt')]
@@ -231,7 +347,15 @@ class Model(nn.Module):
                 os.path.join(apath, 'model_{}.pt'.format(epoch))
             )
 
-        for s in save_dirs:
-            torch.save(self.model.state_dict(), s)
+        # 临时文件+rename，中途崩溃不会留下不完整的model_latest.pt
+        import utility
+        if state_dict is None:
+            state_dict = self.model.state_dict()
+            if writer is not None:
+                state_dict = utility.snapshot(state_dict)
+        if writer is None:
+            utility.save_atomic(state_dict, *save_dirs)
+        else:
+            writer.submit(utility.save_atomic, state_dict, *save_dirs)
 
 
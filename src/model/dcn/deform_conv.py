@@ -3,14 +3,19 @@ import logging
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.nn.modules.utils import _pair
 
-from . import deform_conv_cuda
-
 logger = logging.getLogger('base')
 
+try:
+    from . import deform_conv_cuda
+except ImportError:
+    deform_conv_cuda = None
+    logger.info('deform_conv_cuda is not built, using the pure PyTorch deformable convolution.')
+
 
 class DeformConvFunction(Function):
     @staticmethod
@@ -154,8 +159,87 @@ class ModulatedDeformConvFunction(Function):
         return n, channels_out, height_out, width_out
 
 
-deform_conv = DeformConvFunction.apply
-modulated_deform_conv = ModulatedDeformConvFunction.apply
+def _deform_im2col(input, offset, mask, kernel_size, stride, padding, dilation,
+                   deformable_groups):
+    """Sample the deformed kernel taps of every output location.
+
+    Mirrors deformable_im2col in the CUDA kernel: offsets are laid out as
+    (dy, dx) pairs per kernel tap and deformable group, and taps falling
+    outside the input are bilinearly blended with zeros.
+
+    Returns a tensor of shape (N, C, kh * kw, Ho * Wo).
+    """
+    n, c, h, w = input.shape
+    kh, kw = kernel_size
+    ho, wo = offset.shape[2:]
+    k = kh * kw
+    dg = deformable_groups
+
+    ys = torch.arange(ho, device=input.device, dtype=input.dtype) * stride[0] - padding[0]
+    xs = torch.arange(wo, device=input.device, dtype=input.dtype) * stride[1] - padding[1]
+    ky = torch.arange(kh, device=input.device, dtype=input.dtype) * dilation[0]
+    kx = torch.arange(kw, device=input.device, dtype=input.dtype) * dilation[1]
+    base_y = ky.view(kh, 1, 1, 1) + ys.view(1, 1, ho, 1)
+    base_x = kx.view(1, kw, 1, 1) + xs.view(1, 1, 1, wo)
+    base_y = base_y.expand(kh, kw, ho, wo).reshape(k, ho, wo)
+    base_x = base_x.expand(kh, kw, ho, wo).reshape(k, ho, wo)
+
+    offset = offset.view(n, dg, k, 2, ho, wo)
+    py = base_y + offset[:, :, :, 0]
+    px = base_x + offset[:, :, :, 1]
+    # With align_corners=False, pixel index p maps to (2p + 1) / size - 1, which grid_sample
+    # maps back to exactly p for every size, including H or W == 1 (align_corners=True would
+    # need size - 1 in the denominator and sends every tap to pixel 0 when the size is 1).
+    grid = torch.stack(((2 * px + 1) / w - 1, (2 * py + 1) / h - 1), dim=-1)
+    grid = grid.view(n * dg, k * ho, wo, 2)
+
+    columns = F.grid_sample(
+        input.reshape(n * dg, c // dg, h, w), grid, mode='bilinear', padding_mode='zeros',
+        align_corners=False)
+    columns = columns.view(n, dg, c // dg, k, ho, wo)
+    if mask is not None:
+        columns = columns * mask.view(n, dg, 1, k, ho, wo)
+
+    return columns.view(n, c, k, ho * wo)
+
+
+def _deform_conv_pytorch(input, offset, mask, weight, bias, stride, padding, dilation, groups,
+                         deformable_groups):
+    if input.dim() != 4:
+        raise ValueError("Expected 4D tensor as input, got {}D tensor instead.".format(
+            input.dim()))
+    stride, padding, dilation = _pair(stride), _pair(padding), _pair(dilation)
+    n = input.size(0)
+    out_channels = weight.size(0)
+    ho, wo = offset.shape[2:]
+
+    columns = _deform_im2col(input, offset, mask, weight.shape[2:], stride, padding, dilation,
+                             deformable_groups)
+    columns = columns.view(n, groups, -1, ho * wo)
+    output = torch.matmul(weight.view(groups, out_channels // groups, -1), columns)
+    output = output.view(n, out_channels, ho, wo)
+    if bias is not None:
+        output = output + bias.view(1, -1, 1, 1)
+
+    return output
+
+
+def deform_conv(input, offset, weight, stride=1, padding=0, dilation=1, groups=1,
+                deformable_groups=1, im2col_step=64):
+    if deform_conv_cuda is not None and input.is_cuda:
+        return DeformConvFunction.apply(input, offset, weight, stride, padding, dilation, groups,
+                                        deformable_groups, im2col_step)
+    return _deform_conv_pytorch(input, offset, None, weight, None, stride, padding, dilation,
+                                groups, deformable_groups)
+
+
+def modulated_deform_conv(input, offset, mask, weight, bias=None, stride=1, padding=0,
+                          dilation=1, groups=1, deformable_groups=1):
+    if deform_conv_cuda is not None and input.is_cuda:
+        return ModulatedDeformConvFunction.apply(input, offset, mask, weight, bias, stride,
+                                                 padding, dilation, groups, deformable_groups)
+    return _deform_conv_pytorch(input, offset, mask, weight, bias, stride, padding, dilation,
+                                groups, deformable_groups)
 
 
 class DeformConv(nn.Module):
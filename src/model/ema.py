@@ -0,0 +1,51 @@
+"""
+参数的指数滑动平均（EMA）：
+    shadow = decay * shadow + (1 - decay) * param
+每every个训练step更新一次，decay按decay ** every折算，平均的时间尺度与每步更新相同
+更新使用torch._foreach_*，所有参数一次完成（少量kernel），不逐个参数循环
+buffer（如BatchNorm的running_mean）不做平均，使用模型当前的值
+"""
+from collections import OrderedDict
+
+import torch
+
+class EMA():
+    def __init__(self, net, decay=0.999, every=1):
+        self.names = [n for n, p in net.named_parameters() if p.requires_grad]
+        self.params = [p for p in net.parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
+        self.net = net
+        self.decay = decay ** every
+        self.every = every
+        self.steps = 0
+
+    @torch.no_grad()
+    def update(self):
+        self.steps += 1
+        if self.steps % self.every != 0: return
+
+        torch._foreach_mul_(self.shadow, self.decay)
+        torch._foreach_add_(self.shadow, self.params, alpha=1 - self.decay)
+
+    @torch.no_grad()
+    def swap(self):
+        """
+        交换模型参数与EMA参数（只交换.data，不拷贝），再调用一次恢复
+        参数对象本身不变，DDP、torch.compile、优化器中的引用仍然有效
+        """
+        for p, s in zip(self.params, self.shadow):
+            p.data, s.data = s.data, p.data
+
+    def state_dict(self):
+        # 与Model.model.state_dict()格式相同，可以直接用于--pre_train
+        state = self.net.state_dict()
+        ema = OrderedDict(state)
+        for n, s in zip(self.names, self.shadow):
+            ema[n] = s
+        if hasattr(state, '_metadata'): ema._metadata = state._metadata
+        return ema
+
+    @torch.no_grad()
+    def load_state_dict(self, state):
+        for n, s in zip(self.names, self.shadow):
+            if n in state: s.copy_(state[n])
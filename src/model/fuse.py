@@ -0,0 +1,95 @@
+"""
+推理前的模型化简（只在eval模式下使用，化简后的模型不再用于训练和保存）：
+1、Conv + BatchNorm合并成一个Conv（common.BasicBlock、bn=True的ResBlock/RCAB等）
+2、MeanShift合并到相邻的卷积中
+3、删除合并后变成恒等映射的层
+"""
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from model import common
+
+def fuse_conv_bn(module):
+    """
+    递归查找nn.Sequential中相邻的Conv2d、BatchNorm2d，合并后删除BatchNorm2d
+    returns : 合并的数量
+    """
+    n = 0
+    for child in module.children():
+        n += fuse_conv_bn(child)
+
+    if isinstance(module, nn.Sequential):
+        names = list(module._modules.keys())
+        for a, b in zip(names[:-1], names[1:]):
+            conv, bn = module._modules.get(a), module._modules.get(b)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[a] = fuse_conv_bn_eval(conv, bn)
+                # Sequential按_modules顺序调用，直接删除即可，其他层的名称不变
+                del module._modules[b]
+                n += 1
+    return n
+
+def _last_conv(module):
+    if isinstance(module, nn.Sequential) and len(module) > 0:
+        return _last_conv(module[-1])
+    return module if isinstance(module, nn.Conv2d) else None
+
+def fold_mean_shift(net):
+    """
+    add_mean（1x1卷积）接在tail最后一个卷积之后，两个线性层直接合并：
+        W' = W_m W, b' = W_m b + b_m
+    sub_mean只有在head卷积没有padding时才能精确合并：
+    head的zero padding作用在减均值之后，合并到原始输入上时边界像素的结果会改变，
+    所以对常用的3x3 head卷积保留sub_mean
+    returns : 合并掉的MeanShift名称
+    """
+    folded = []
+    # HAN在shift_mean=False时不使用sub_mean/add_mean
+    if not getattr(net, 'shift_mean', True):
+        return folded
+
+    add_mean = getattr(net, 'add_mean', None)
+    tail = _last_conv(getattr(net, 'tail', None))
+    if isinstance(add_mean, common.MeanShift) and tail is not None \
+            and tail.out_channels == add_mean.in_channels and tail.groups == 1:
+        w_m = add_mean.weight.data.view(add_mean.out_channels, -1)
+        w = tail.weight.data
+        tail.weight.data = (w_m @ w.view(w.size(0), -1)).view(-1, *w.shape[1:])
+        bias = add_mean.bias.data.clone()
+        if tail.bias is not None:
+            bias += w_m @ tail.bias.data
+        else:
+            tail.bias = nn.Parameter(bias.new_zeros(tail.out_channels))
+        tail.bias.data = bias
+        net.add_mean = nn.Identity()
+        folded.append('add_mean')
+
+    sub_mean = getattr(net, 'sub_mean', None)
+    head = getattr(net, 'head', None)
+    head = head[0] if isinstance(head, nn.Sequential) and len(head) > 0 else head
+    if isinstance(sub_mean, common.MeanShift) and isinstance(head, nn.Conv2d) \
+            and head.in_channels == sub_mean.out_channels and head.groups == 1 \
+            and all(p == 0 for p in head.padding):
+        w_m = sub_mean.weight.data.view(sub_mean.out_channels, -1)
+        w = head.weight.data
+        if head.bias is None:
+            head.bias = nn.Parameter(w.new_zeros(head.out_channels))
+        head.bias.data += w.sum((2, 3)) @ sub_mean.bias.data
+        head.weight.data = (w.permute(0, 2, 3, 1) @ w_m).permute(0, 3, 1, 2).contiguous()
+        net.sub_mean = nn.Identity()
+        folded.append('sub_mean')
+
+    return folded
+
+def fuse_for_inference(net):
+    """
+    inputs :
+        net : eval模式下的网络（Model.model），原地修改
+    returns :
+        记录合并情况的字符串，用于写入log
+    """
+    n_bn = fuse_conv_bn(net)
+    folded = fold_mean_shift(net)
+
+    return 'Conv+BN: {}, MeanShift: {}'.format(
+        n_bn, ', '.join(folded) if folded else 'none')
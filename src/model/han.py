@@ -2,7 +2,6 @@ from model import common
 # import common
 import torch
 import torch.nn as nn
-import pdb
 
 def make_model(args, parent=False):
     return HAN(args)
@@ -44,17 +43,15 @@ class LAM_Module(nn.Module):
                 attention: B X N X N
         """
         m_batchsize, N, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
-        energy = torch.bmm(proj_query, proj_key)
+        # channels_last时x不连续，view会报错；reshape只复制一次，query/key/value共用
+        proj_value = x.reshape(m_batchsize, N, -1)
+        energy = torch.bmm(proj_value, proj_value.transpose(1, 2))
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
 
-        out = self.gamma*out + x
+        out = self.gamma*out + proj_value
         out = out.view(m_batchsize, -1, height, width)
         return out
 
@@ -92,7 +89,7 @@ class CSAM_Module(nn.Module):
         # out = out.view(m_batchsize, N, C, height, width)
 
         out = self.gamma*out
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         x = x * out + x
         return x
 
@@ -201,14 +198,13 @@ class HAN(nn.Module):
 
         x = self.head(x)
         res = x
-        #pdb.set_trace()
-        for name, midlayer in self.body._modules.items():
+        # 收集每一层的输出，最后一次拼接（最新的一层在前，与原来逐层cat的顺序一致）
+        # 不再按模块名判断，便于torch.jit.trace / onnx导出
+        feats = []
+        for midlayer in self.body:
             res = midlayer(res)
-            #print(name)
-            if name=='0':
-                res1 = res.unsqueeze(1)
-            else:
-                res1 = torch.cat([res.unsqueeze(1),res1],1)
+            feats.append(res.unsqueeze(1))
+        res1 = torch.cat(feats[::-1], 1)
         #res = self.body(x)
         out1 = res
         #res3 = res.unsqueeze(1)
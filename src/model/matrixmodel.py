@@ -16,13 +16,15 @@ import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
 from model import ops
-import pdb
 
 
-try:
-    from model.dcn.deform_conv import ModulatedDeformConvPack as DCN
-except ImportError:
-    raise ImportError('Failed to import DCNv2 module.')
+def DCN(*args, **kwargs):
+    # 只有PD/PDF用到DCNv2，推迟到构建时再导入
+    try:
+        from model.dcn.deform_conv import ModulatedDeformConvPack
+    except ImportError:
+        raise ImportError('Failed to import DCNv2 module.')
+    return ModulatedDeformConvPack(*args, **kwargs)
 
 BN_MOMENTUM = 0.1
 logger = logging.getLogger(__name__)
@@ -96,7 +98,7 @@ class BFN(nn.Module):
         return nn.Sequential(*blocks)
 
     def forward(self, x):
-        assert type(x) is tuple and len(x)==3
+        assert isinstance(x, tuple) and len(x)==3
         #branch1
         res1 = x[0]
         out1 = self.branch1(x[0])
@@ -112,7 +114,7 @@ class BFN(nn.Module):
         out3 = self.branch3(x[2])
         out3 += res3
 
-        return (out1,out2,out3)
+        return ops.Octave((out1,out2,out3))
 
 class BFN1(nn.Module):
     def __init__(self, num_channels, kernel_size, reduction, n_blocks, block):
@@ -165,7 +167,7 @@ class BFN2(nn.Module):
         return nn.Sequential(*blocks)
 
     def forward(self, x):
-        assert type(x) is tuple and len(x)==2
+        assert isinstance(x, tuple) and len(x)==2
         #branch1
         res1 = x[0]
         out1 = self.branch1(x[0])
@@ -176,29 +178,32 @@ class BFN2(nn.Module):
         out2 = self.branch2(x[1])
         out2 += res2
 
-        return (out1,out2)
+        return ops.Octave((out1,out2))
 
 class EoctResBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, in_channels, num_channels, stride=1, downsample=None, res_scale=1, **kwargs):
+    def __init__(self, in_channels, num_channels, stride=1, downsample=None, res_scale=1, bn=False, **kwargs):
         super(EoctResBlock, self).__init__()
         self.num_channels = num_channels # (64,64,64)
         self.stride = stride
         self.downsample = downsample
         self.res_scale = res_scale
         self.conv1 = ops.EoctConv(in_channels, num_channels, stride=stride)
+        # bn=True时每个EoctConv之后接OctaveBN；默认不加，state_dict与原来相同
+        self.bn1 = ops.OctaveBN(num_channels) if bn else None
         self.conv2 = ops.EoctConv(num_channels, num_channels)
+        self.bn2 = ops.OctaveBN(num_channels) if bn else None
 
     def forward(self, x):
         residual = x
 
         out = self.conv1(x)
-        #out = ops.bn(out, self.num_channels)
+        if self.bn1 is not None: out = self.bn1(out)
         out = ops.relu(out)
 
         out = self.conv2(out)
-        #out = ops.bn(out, self.num_channels)
+        if self.bn2 is not None: out = self.bn2(out)
         
         if self.downsample is not None:
             residual = self.downsample(x)
@@ -228,14 +233,11 @@ class EoctBottleneck(nn.Module):
         residual = x
 
         out = self.conv1(x)
-        #out = ops.bn(out, self.num_channels)
         out = ops.relu(out)
 
         out = self.conv2(out)
-        #out = ops.bn(out, self.num_channels)
         
         out = self.conv3(out)
-        #out = ops.bn(out, self.num_channels)
         
         if self.downsample is not None:
             residual = self.downsample(x)
@@ -1739,14 +1741,14 @@ class PAM_Module(nn.Module):
                 attention: B X (HxW) X (HxW)
         """
         m_batchsize, C, height, width = x.size()
-        proj_query = self.query_conv(x).view(m_batchsize, -1, width*height).permute(0, 2, 1)
-        proj_key = self.key_conv(x).view(m_batchsize, -1, width*height)
+        proj_query = self.query_conv(x).reshape(m_batchsize, -1, width*height).permute(0, 2, 1)
+        proj_key = self.key_conv(x).reshape(m_batchsize, -1, width*height)
         energy = torch.bmm(proj_query, proj_key)
         attention = self.softmax(energy)
-        proj_value = self.value_conv(x).view(m_batchsize, -1, width*height)
+        proj_value = self.value_conv(x).reshape(m_batchsize, -1, width*height)
 
         out = torch.bmm(proj_value, attention.permute(0, 2, 1))
-        out = out.view(m_batchsize, C, height, width)
+        out = out.reshape(m_batchsize, C, height, width)
 
         out = self.gamma*out + x
         return out
@@ -1770,15 +1772,15 @@ class CAM_Module(nn.Module):
                 attention: B X C X C
         """
         m_batchsize, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, C, -1)
-        proj_key = x.view(m_batchsize, C, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, C, -1)
+        proj_key = x.reshape(m_batchsize, C, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, C, -1)
+        proj_value = x.reshape(m_batchsize, C, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, C, height, width)
+        out = out.reshape(m_batchsize, C, height, width)
 
         out = self.gamma*out + x
         return out
@@ -1801,16 +1803,16 @@ class GAM_Module(nn.Module):
                 attention: B X (C*H*W) X (C*H*W)
         """
         m_batchsize, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, -1).unsqueeze(-1)
-        proj_key = x.view(m_batchsize, -1).unsqueeze(-1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, -1).unsqueeze(-1)
+        proj_key = x.reshape(m_batchsize, -1).unsqueeze(-1).permute(0, 2, 1)
         #pdb.set_trace()
         energy = torch.bmm(proj_query, proj_key)
         #energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy)
-        proj_value = x.view(m_batchsize, -1).unsqueeze(-1)
+        proj_value = x.reshape(m_batchsize, -1).unsqueeze(-1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, C, height, width)
+        out = out.reshape(m_batchsize, C, height, width)
 
         out = self.gamma*out + x
         return out
@@ -1833,17 +1835,15 @@ class DAM_Module(nn.Module):
                 attention: B X N X N
         """
         m_batchsize, N, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
-        energy = torch.bmm(proj_query, proj_key)
+        # channels_last时x不连续，view会报错；reshape只复制一次，query/key/value共用
+        proj_value = x.reshape(m_batchsize, N, -1)
+        energy = torch.bmm(proj_value, proj_value.transpose(1, 2))
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
 
-        out = self.gamma*out + x
+        out = self.gamma*out + proj_value
         out = out.view(m_batchsize, -1, height, width)
         return out
 
@@ -4,7 +4,6 @@ import torch.nn.functional as F
 import torch
 import numpy as np
 import math
-import pdb
 
 BN_MOMENTUM = 0.1
 class EoctConv(nn.Module):
@@ -31,6 +30,9 @@ class EoctConv(nn.Module):
         self.num_high = num_high
         self.num_low = num_low
         self.num_ll = num_ll
+        # 输入的频率分组在构建时就确定，forward中不再逐次判断tuple类型
+        self.has_l = in_l is not None
+        self.has_ll = in_ll is not None
         if in_h is not None:
             self.conv2d1 = nn.Conv2d(in_h, num_high, kernel_size=3, stride=1, padding=1, bias=bias) if self.num_high > 0 else None
             self.conv2d2 = nn.Conv2d(in_h, num_low, kernel_size=3, stride=1, padding=1, bias=bias) if self.num_low > 0 else None
@@ -47,19 +49,114 @@ class EoctConv(nn.Module):
         self.upsample2 = nn.Upsample(scale_factor=4, mode='nearest')
         self.pooling1 = nn.AvgPool2d(kernel_size=2, stride=2, padding=0)
         self.pooling2 = nn.AvgPool2d(kernel_size=4, stride=4, padding=0)
+        # 推理时拼接后的卷积权重的缓存（不在state_dict中），见_fused
+        self._fused_cache = {}
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0]*m.kernel_size[1]*m.out_channels
                 m.weight.data.normal_(0, math.sqrt(2. / n))
                 nn.init.constant(m.bias,0)
     def forward(self, data):
+        """
+        stride=1时的快速实现，与_forward_reference结果一致：
+        1、作用在同一输入上的卷积合并成一个卷积（输出通道拼接），再split
+        2、输出到同一频率、输入分辨率相同的卷积，按输入通道拼接成一个卷积，求和在卷积内部完成
+        3、每个频率的池化只计算一次，4倍池化由2倍池化结果再池化得到
+        4、各分支结果原地累加
+        参数仍保存在conv2d1~conv2d9中，原有的模型参数文件可以直接加载
+        """
+        if self.stride != 1:
+            return self._forward_reference(data)
+
+        if self.has_ll:
+            data_h, data_l, data_ll = data
+        elif self.has_l:
+            (data_h, data_l), data_ll = data, None
+        else:
+            data_h, data_l, data_ll = data, None, None
+        data_h2h, data_2l, data_2ll = None, None, None
+
+        pool_h = F.avg_pool2d(data_h, 2) if (self.num_low > 0 or self.num_ll > 0) else None
+
+        # Lower -> High / Low：共享输入data_ll
+        data_ll2h, data_ll2l = None, None
+        if data_ll is not None and (self.num_high > 0 or self.num_low > 0):
+            convs = [c for c in (self.conv2d8, self.conv2d9) if c is not None]
+            out = _conv2d(data_ll, *self._fused('ll', _cat_out, convs), convs[0])
+            if self.num_high > 0 and self.num_low > 0:
+                data_ll2h, data_ll2l = torch.split(out, [self.num_high, self.num_low], dim=1)
+            elif self.num_high > 0:
+                data_ll2h = out
+            else:
+                data_ll2l = out
+
+        # -> High
+        if self.num_high > 0:
+            data_h2h = self.conv2d1(data_h)
+            if data_l is not None:
+                data_h2h += F.interpolate(self.conv2d5(data_l), scale_factor=2, mode='nearest')
+            if data_ll2h is not None:
+                data_h2h += F.interpolate(data_ll2h, scale_factor=4, mode='nearest')
+
+        # -> Low：High(2倍池化)与Low合并为一个卷积
+        if self.num_low > 0:
+            inputs, convs = [pool_h], [self.conv2d2]
+            if data_l is not None:
+                inputs.append(data_l)
+                convs.append(self.conv2d4)
+            data_2l = _conv2d(_cat(inputs), *self._fused('l', _cat_in, convs), convs[0])
+            if data_ll2l is not None:
+                data_2l += F.interpolate(data_ll2l, scale_factor=2, mode='nearest')
+
+        # -> Lower：High(4倍池化)、Low(2倍池化)与Lower合并为一个卷积
+        if self.num_ll > 0:
+            inputs, convs = [F.avg_pool2d(pool_h, 2)], [self.conv2d3]
+            if data_l is not None:
+                inputs.append(F.avg_pool2d(data_l, 2))
+                convs.append(self.conv2d6)
+            if data_ll is not None:
+                inputs.append(data_ll)
+                convs.append(self.conv2d7)
+            data_2ll = _conv2d(_cat(inputs), *self._fused('2ll', _cat_in, convs), convs[0])
+
+        # squeeze output (to be backward compatible)
+        if data_2ll is None:
+            if data_2l is None:
+                return data_h2h
+            else:
+                return Octave((data_h2h, data_2l))
+        elif data_2l is None:
+            return Octave((data_h2h, data_2ll))
+        else:
+            return Octave((data_h2h, data_2l, data_2ll))
+
+    def _fused(self, key, fuse, convs):
+        """
+        拼接后的权重、偏置
+        需要梯度时（训练）每次重新拼接：梯度要经过cat回传到conv2d1~conv2d9，
+        cat只拷贝一次权重（数量级为参数量），相对卷积本身的计算量可以忽略
+        不需要梯度时（测试）缓存拼接结果；参数被原地修改（_version变化）、
+        或被替换（half()、load_state_dict之外的赋值，data_ptr变化）后重新拼接
+        """
+        if len(convs) == 1 or torch.is_grad_enabled():
+            return fuse(convs)
+
+        params = [p for c in convs for p in (c.weight, c.bias) if p is not None]
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        cached = self._fused_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, fuse(convs))
+            self._fused_cache[key] = cached
+        return cached[1]
+
+    def _forward_reference(self, data):
         #pdb.set_trace()
         stride = self.stride
         
         #input channels
-        if type(data) is tuple and len(data)==3:
+        if isinstance(data, tuple) and len(data)==3:
             data_h, data_l ,data_ll= data
-        elif type(data) is tuple and len(data)==2:
+        elif isinstance(data, tuple) and len(data)==2:
             data_h, data_l = data
             data_ll = None
         else:
@@ -117,127 +214,106 @@ class EoctConv(nn.Module):
             if output[1] is None:
                 return output[0]
             else:
-                return output[0:2]
+                return Octave(output[0:2])
         elif output[1] is None:
-            return output[0::2]
+            return Octave(output[0::2])
         else:
-            return output
+            return Octave(output)
         
+def _cat(inputs):
+    return inputs[0] if len(inputs) == 1 else torch.cat(inputs, dim=1)
+
+def _cat_in(convs):
+    # conv_a(x_a) + conv_b(x_b) == conv([x_a, x_b])：权重按输入通道拼接，偏置相加
+    if len(convs) == 1:
+        return convs[0].weight, convs[0].bias
+    weight = torch.cat([c.weight for c in convs], dim=1)
+    bias = None if convs[0].bias is None else sum(c.bias for c in convs)
+    return weight, bias
+
+def _cat_out(convs):
+    # 同一输入上的多个卷积：权重与偏置按输出通道拼接
+    if len(convs) == 1:
+        return convs[0].weight, convs[0].bias
+    weight = torch.cat([c.weight for c in convs], dim=0)
+    bias = None if convs[0].bias is None else torch.cat([c.bias for c in convs], dim=0)
+    return weight, bias
+
+def _conv2d(x, weight, bias, conv):
+    return F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+class Octave(tuple):
+    """
+    高/低/更低频率特征的容器，EoctConv的多频率输出都使用这个类型
+    仍然是tuple的子类：下标、解包、len与原来的tuple输出一致
+    __slots__为空，不增加每个实例的内存开销
+    带下划线的方法在各频率分支上原地计算，不分配新的特征图
+    """
+    __slots__ = ()
+
+    def map(self, fn):
+        return Octave(None if d is None else fn(d) for d in self)
+
+    def relu_(self):
+        for d in self:
+            if d is not None:
+                d.relu_()
+        return self
+
+    def add_(self, other):
+        assert len(self) == len(other)
+        for d, o in zip(self, other):
+            if d is not None:
+                d.add_(o)
+        return self
+
+    def mul_(self, other):
+        assert len(self) == len(other)
+        for d, o in zip(self, other):
+            if d is not None:
+                d.mul_(o)
+        return self
+
+class OctaveBN(nn.Module):
+    """
+    每个频率一个BatchNorm2d，在__init__中建立一次，参数随模型训练，running统计量随模型保存
+    （代替原来的bn函数：每次调用都新建BatchNorm2d，参数不训练，统计量也不保留）
+    """
+    def __init__(self, num_channels, momentum=BN_MOMENTUM):
+        super(OctaveBN, self).__init__()
+        if not isinstance(num_channels, tuple):
+            num_channels = (num_channels,)
+        self.bns = nn.ModuleList([nn.BatchNorm2d(c, momentum=momentum) for c in num_channels if c > 0])
+
+    def forward(self, data):
+        if isinstance(data, tuple):
+            assert len(data) == len(self.bns)
+            return Octave(bn(d) for bn, d in zip(self.bns, data))
+        return self.bns[0](data)
+
+def _map(fn, data):
+    if isinstance(data, tuple):
+        return Octave(data).map(fn)
+    return fn(data)
+
 def relu(data):
-    relu = nn.ReLU(inplace=True)
-    if type(data) is tuple and len(data)==3:
-        out = (relu(data[0]), relu(data[1]), relu(data[2]))
-        return out
-        
-    elif type(data) is tuple and len(data)==2:
-        if data[0] is None:
-            out = (relu(data[1]), relu(data[2]))
-            return out
-        elif data[1] is None:
-            out = (relu(data[0]), relu(data[2]))
-            return out
-        else:
-            out = (relu(data[0]), relu(data[1]))
-            return out
-    else:
-        out = relu(data)
-        return out
-        
+    """原地relu（与原来nn.ReLU(inplace=True)一致），不再每次新建ReLU模块"""
+    if isinstance(data, tuple):
+        return Octave(data).relu_()
+    return data.relu_()
+
 def sigmoid(data):
-    if type(data) is tuple and len(data)==3:
-        out = (F.sigmoid(data[0]), F.sigmoid(data[1]), F.sigmoid(data[2]))
-        return out
-        
-    elif type(data) is tuple and len(data)==2:
-        if data[0] is None:
-            out = (F.sigmoid(data[1]), F.sigmoid(data[2]))
-            return out
-        elif data[1] is None:
-            out = (F.sigmoid(data[0]), F.sigmoid(data[2]))
-            return out
-        else:
-            out = (F.sigmoid(data[0]), F.sigmoid(data[1]))
-            return out
-    elif type(data) is Tensor:
-        out = F.sigmoid(data)
-        return out
+    return _map(torch.sigmoid, data)
 
-def bn(data, num_channels):
-    if type(data) is tuple and len(data)==3:
-        bn1 = nn.BatchNorm2d(num_channels[0], momentum=BN_MOMENTUM)
-        bn2 = nn.BatchNorm2d(num_channels[1], momentum=BN_MOMENTUM)
-        bn3 = nn.BatchNorm2d(num_channels[2], momentum=BN_MOMENTUM)
-        out = (bn1(data[0]), bn2(data[1]), bn3(data[2]))
-        return out
-    elif type(data) is tuple and len(data)==2:
-        bn1 = nn.BatchNorm2d(num_channels[0], momentum=BN_MOMENTUM)
-        bn2 = nn.BatchNorm2d(num_channels[1], momentum=BN_MOMENTUM)
-        out = (bn1(data[0]), bn2(data[1]))
-        return out
-    elif type(data) is Tensor:
-        bn1 = nn.BatchNorm2d(num_channels, momentum=BN_MOMENTUM)
-        out = bn1(data)
-        return out
-    
 def max_pool2d(data, l=(2,2)):
-    if type(data) is tuple and len(data)==3:
-        out = (F.max_pool2d(data[0], l), F.max_pool2d(data[1], l), F.max_pool2d(data[2], l))
-        return out
-        
-    elif type(data) is tuple and len(data)==2:
-        if data[0] is None:
-            out = (F.max_pool2d(data[1], l), F.max_pool2d(data[2], l))
-            return out
-        elif data[1] is None:
-            out = (F.max_pool2d(data[0], l), F.max_pool2d(data[2], l))
-            return out
-        else:
-            out = (F.max_pool2d(data[0], l), F.max_pool2d(data[1], l))
-            return out
-    elif type(data) is Tensor:
-        out = F.max_pool2d(data, l)
-        return out
-        
+    return _map(lambda d: F.max_pool2d(d, l), data)
+
 def avg_pool2d(data):
-    avg_pool = nn.AdaptiveAvgPool2d(1)
-    if type(data) is tuple and len(data)==3:
-        out = (avg_pool(data[0]), avg_pool(data[1]), avg_pool(data[2]))
-        return out
-        
-    elif type(data) is tuple and len(data)==2:
-        if data[0] is None:
-            out = (avg_pool(data[1]), avg_pool(data[2]))
-            return out
-        elif data[1] is None:
-            out = (avg_pool(data[0]), avg_pool(data[2]))
-            return out
-        else:
-            out = (avg_pool(data[0]), avg_pool(data[1]))
-            return out
-    elif type(data) is Tensor:
-        out = avg_pool(data)
-        return out
+    return _map(lambda d: F.adaptive_avg_pool2d(d, 1), data)
 
 def dropout(data, l):
-    Dropout = nn.Dropout(l)
-    if type(data) is tuple and len(data)==3:
-        out = (Dropout(data[0]), Dropout(data[1]), Dropout(data[2]))
-        return out
-        
-    elif type(data) is tuple and len(data)==2:
-        if data[0] is None:
-            out = (Dropout(data[1]), Dropout(data[2]))
-            return out
-        elif data[1] is None:
-            out = (Dropout(data[0]), Dropout(data[2]))
-            return out
-        else:
-            out = (Dropout(data[0]), Dropout(data[1]))
-            return out
-    elif type(data) is Tensor:
-        out = Dropout(data)
-        return out
-        
+    return _map(lambda d: F.dropout(d, l), data)
+
 def dataSum(a, b):
     if a is None:
         return b
@@ -250,8 +326,13 @@ def dataSum(a, b):
 
 
 def tupleSum(a,b):
-    out = (a[0]+b[0],a[1]+b[1],a[2]+b[2])
-    return(out)
+    """
+    a += b，按频率原地相加，结果写回a
+    a必须是之后不再单独使用的中间结果（卷积输出等），残差b不会被修改
+    """
+    if isinstance(a, tuple):
+        return Octave(a).add_(b)
+    return a.add_(b)
         
 class MeanShift(nn.Conv2d):
     def __init__(self, rgb_range, rgb_mean, rgb_std, sign=-1):
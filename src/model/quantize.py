@@ -0,0 +1,65 @@
+"""
+训练后静态int8量化（CPU推理），支持EDSR、RCAN、HAN
+使用FX graph mode：残差相加、CALayer的乘法等由FX自动插入量化/反量化
+以下部分保持float：
+1、LAM/CSAM注意力（reshape + bmm，量化误差大，且forward中对size()解包，FX无法trace）
+2、PixelShuffle
+3、MeanShift（输入输出像素值，保留完整精度）
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from model import common
+
+supported = ('EDSR', 'RCAN', 'HAN')
+float_modules = ('LAM_Module', 'CSAM_Module')
+
+def _quantize_fx():
+    try:
+        from torch.ao.quantization import QConfigMapping, get_default_qconfig
+        from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    except ImportError:
+        raise ImportError('Static quantization requires torch>=1.13 (torch.ao.quantization).')
+
+    return QConfigMapping, get_default_qconfig, PrepareCustomConfig, prepare_fx, convert_fx
+
+def prepare(net, example, backend='fbgemm'):
+    """
+    inputs :
+        net : float网络（Model.model），不会被修改
+        example : 一个输入batch（cpu），用于FX trace
+    returns :
+        插入observer的网络，用calibrate跑几个batch后再convert
+    """
+    QConfigMapping, get_default_qconfig, PrepareCustomConfig, prepare_fx, _ = _quantize_fx()
+    torch.backends.quantized.engine = backend
+
+    net = copy.deepcopy(net).cpu().eval()
+    skip = [type(m) for m in net.modules() if type(m).__name__ in float_modules]
+    skip = list(set(skip))
+
+    qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(backend))
+    for t in skip + [nn.PixelShuffle, common.MeanShift]:
+        qconfig_mapping = qconfig_mapping.set_object_type(t, None)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes(skip)
+
+    return prepare_fx(net, qconfig_mapping, (example,), prepare_custom_config=custom_config)
+
+def calibrate(prepared, batches):
+    with torch.no_grad():
+        for lr in batches:
+            prepared(lr)
+
+def convert(prepared):
+    _, _, _, _, convert_fx = _quantize_fx()
+
+    return convert_fx(prepared)
+
+def save(qnet, example, path):
+    """量化后的GraphModule以TorchScript保存，加载时不需要重新prepare"""
+    with torch.no_grad():
+        traced = torch.jit.trace(qnet, example)
+    torch.jit.save(traced, path)
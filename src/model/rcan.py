@@ -1,9 +1,7 @@
-# from model import common
-import common
+from model import common
 import torch
 import torch.nn as nn
 import numpy as np
-import pdb
 
 def make_model(args, parent=False):
     return RCAN(args)
@@ -1,9 +1,8 @@
-# from model import common
-import common
+from model import common
+# import common
 import torch.nn as nn
 import torch
 import torch.nn.init as init
-import pdb
 
 def make_model(args, parent=False):
     return RCAN(args)
@@ -32,8 +31,6 @@ class Dis(nn.Module):
         super(Dis, self).__init__()
         self.loss_type = loss_type
         #self.loss = torch.zeros(B)
-        if self.loss_type == 'cos':
-            self.dot_product, self.square_sum_x, self.square_sum_y = torch.zeros(batchsize).cuda(), torch.zeros(batchsize).cuda(), torch.zeros(batchsize).cuda()
 
 
     def forward(self, x1, x2):
@@ -47,6 +44,25 @@ class Dis(nn.Module):
         if self.loss_type=='cos':
             return self.cosine_similarity(x1, x2)
 
+    def pairwise(self, x1, x2):
+        """
+            inputs :
+                x1 : B X N1 X C
+                x2 : B X N2 X C
+            returns :
+                out : B X N1 X N2, out[:,i,j] == self.forward(x1[:,i], x2[:,j])
+        """
+        if self.loss_type=='L1':
+            return torch.cdist(x1, x2, p=1)
+
+        if self.loss_type=='L2':
+            return torch.cdist(x1, x2, p=2).pow(2)
+
+        if self.loss_type=='cos':
+            x1 = x1 / x1.norm(dim=-1, keepdim=True)
+            x2 = x2 / x2.norm(dim=-1, keepdim=True)
+            return 0.5 * torch.bmm(x1, x2.permute(0, 2, 1)) + 0
+
 
     def L1Loss(self, x1, x2):
 
@@ -74,16 +90,49 @@ class Dis(nn.Module):
         # cos = self.bit_product_sum(x, y) / (torch.sqrt(self.bit_product_sum(x, x)) * torch.sqrt(self.bit_product_sum(y, y)))
 
         #method 3
-        dot_product, square_sum_x, square_sum_y = self.dot_product, self.square_sum_x, self.square_sum_y
-        #pdb.set_trace()
-        for i in range(x.size()[1]):
-            dot_product += x[:,i] * y[:,i]
-            square_sum_x += x[:,i] * x[:,i]
-            square_sum_y += y[:,i] * y[:,i]
+        # 原先在预分配的cuda缓冲区上累加，缓冲区不清零，跨调用会累积；改为每次重新求和
+        dot_product = torch.sum(x * y, dim=1)
+        square_sum_x = torch.sum(x * x, dim=1)
+        square_sum_y = torch.sum(y * y, dim=1)
         cos = dot_product / (torch.sqrt(square_sum_x) * torch.sqrt(square_sum_y))
 
         return 0.5 * cos + 0
 
+def receptive_field_conv(x, index, weight, bias=None, score=None):
+    """
+        inputs :
+            x : flattened feature maps( B X C X HW)
+            index : receptive field of every position( B X HW X K)
+            weight : out_channels X C X K
+            score : optional weight of every receptive field position( B X HW X K)
+        returns :
+            out : B X out_channels X HW
+    """
+    m_batchsize, C, N = x.size()
+    K = index.size(-1)
+    x_K = torch.gather(
+        x.permute(0, 2, 1), 1,
+        index.reshape(m_batchsize, N * K, 1).expand(-1, -1, C)
+    ).reshape(m_batchsize, N, K, C)
+    if score is not None:
+        x_K = x_K * score.unsqueeze(-1)
+    out = torch.einsum('bnkc,ock->bon', x_K, weight)
+    if bias is not None:
+        out = out + bias.reshape(1, -1, 1)
+
+    return out
+
+def chunk_starts(n, k, device=None):
+    """
+    torch.chunk把n个位置分为k段时，每段第一个位置的下标，总是返回k个
+    torch.chunk每段ceil(n/k)个，段数可能少于k（如n=20、k=9时只有7段），
+    这时改为按n/k均匀取k个位置（n < k时有重复）
+    """
+    step = -(-n // k)
+    if (k - 1) * step < n:
+        return torch.arange(k, device=device) * step
+    return torch.div(torch.arange(k, device=device) * n, k, rounding_mode='floor')
+
 class FullConvRes(nn.Module):
     """ Full Receptive Field Conv2d Residual Block"""
     def __init__(self, out_channels=64, in_channels=64, K=9):
@@ -118,12 +167,11 @@ class FullConvRes(nn.Module):
         """
         m_batchsize, C, height, width = x.size()
         #energy1 = torch.zeros((m_batchsize, height*width, height*width)).cuda()
-        proj_query = x.view(m_batchsize, C, -1)
-        proj_key = x.view(m_batchsize, C, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, C, -1)
+        proj_key = x.reshape(m_batchsize, C, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_key, proj_query)
-        energy1 = torch.zeros((m_batchsize, height*width, 1)).cuda()
-        for i in range(height*width):
-            energy1.data[:,i] = torch.sqrt(energy[:,i,i]).unsqueeze(1)
+        # 对角线即各行向量的平方范数；与原先写入.data一致，范数不回传梯度
+        energy1 = torch.sqrt(torch.diagonal(energy, dim1=1, dim2=2)).unsqueeze(2).detach()
         energy2 = energy1.permute(0, 2, 1)
         energy_new = energy/energy1.expand_as(energy)
         energy_new = energy_new/energy2.expand_as(energy)
@@ -133,56 +181,14 @@ class FullConvRes(nn.Module):
 
         #energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         #pdb.set_trace()
-        energy_new = torch.sort(energy_new, dim=-1)[1].float()
-        #pdb.set_trace()
-        e = torch.chunk(energy_new, self.K, dim=-1)
-        for i in range(self.K):
-            if i == 0:
-                energy_new = e[i][:,:,0].unsqueeze(2)
-            else:
-                energy_new = torch.cat([energy_new, e[i][:,:,0].unsqueeze(2)],dim=2)
-        #energy_new = torch.stack(torch.chunk(energy_new, self.K, dim=-1)[:][:,:,0],dim=-1)
-        #energy_new = energy_new[:,:,0,:].long()
-        energy_new = energy_new.long()
-
-        ReceptiveField = torch.zeros_like(energy)
-        for b in range(m_batchsize):
-            for t in range(height*width):
-                for k in range(self.K):
-                    #pdb.set_trace()
-                    ReceptiveField.data[b,t,energy_new[b,t,k]] = 1
-        # max5 = max((1,9))  # 取top1准确率，若取top1和top9准确率改为max((1,9))
-        # max4 = max((1,4))
-        # _, ReceptiveFieldIdex1 = energy_new.topk(max5, -1, True, False)
-        # _, ReceptiveFieldIdex2 = (-1*energy_new).topk(max4, -1, True, False)
-        # ReceptiveFieldIdex = torch.cat([ReceptiveFieldIdex1,ReceptiveFieldIdex2], 2)
-        # ReceptiveFieldIdex = (self.sigmoid(self.conv(ReceptiveFieldIdex.unsqueeze(3)).squeeze(3))*height*width).int()
-
-        #score = self.softmax(score)
-
-        #x_in = x.view(m_batchsize,-1,height*width)
-        out = torch.zeros_like(proj_query).cuda()
-
-        for i in range(self.out_channels):
-            for j in range(height*width):
-                #x_in = x_in[ReceptiveField[:,j,:].unsqueeze(1).expand_as(x_in).long()]
-                #pdb.set_trace()
-                x_out = proj_query[ReceptiveField[:,j].unsqueeze(1).expand_as(proj_query)>0].view(m_batchsize,C,-1)
-                #x_out,_ = x_in.topk(max9, -1, True, False) # The shape of x_in:B X C X 9
-                x_K = torch.sum(x_out*(self.weight[i].expand_as(x_out)), dim=1)
-                out.data[:,i,j] = torch.sum(x_K, dim=1)+self.bias[i]
-        out = self.relu(out.view(m_batchsize,C,height,width))
-
-        # max9 = max((1,9))
-        # for i in range(self.out_channels):
-        #     for j in range(height*width):
-        #         #x_in = x_in[ReceptiveField[:,j,:].unsqueeze(1).expand_as(x_in).long()]
-        #         pdb.set_trace()
-        #         x1 = x_in*(ReceptiveField[:,j].unsqueeze(1).expand_as(x_in)) 
-        #         x_out,_ = x1.topk(max9, -1, True, False) # The shape of x_out:B X C X 9
-        #         x_9 = torch.sum(x_out*(self.weight[i].expand_as(x_out)), dim=1)
-        #         out.data[:,i,j] = torch.sum(x_9, dim=1)+self.bias[i]
-        # out = self.relu(out.view(m_batchsize,C,height,width))
+        # 按相似度排序后均分为K段，取每段的第一个位置作为感受野（与torch.chunk的分段方式一致）
+        order = torch.sort(energy_new, dim=-1)[1]
+        starts = chunk_starts(height*width, self.K, device=x.device)
+        # 循环版本用布尔掩码取值，感受野内的位置按升序排列，这里保持同样的顺序
+        ReceptiveFieldIdex = torch.sort(order[:, :, starts], dim=-1)[0]
+
+        out = receptive_field_conv(proj_query, ReceptiveFieldIdex, self.weight, self.bias)
+        out = self.relu(out.reshape(m_batchsize, self.out_channels, height, width))
 
         return self.gamma * out + x
 
@@ -220,8 +226,8 @@ class FullConvRes1(nn.Module):
         """
         m_batchsize, C, height, width = x.size()
         #energy1 = torch.zeros((m_batchsize, height*width, height*width)).cuda()
-        proj_query = self.query_conv(x).view(m_batchsize, C//8, -1)
-        proj_key = self.key_conv(x).view(m_batchsize, C//8, -1).permute(0, 2, 1)
+        proj_query = self.query_conv(x).reshape(m_batchsize, C//8, -1)
+        proj_key = self.key_conv(x).reshape(m_batchsize, C//8, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_key, proj_query)
         # energy1 = torch.zeros((m_batchsize, height*width, 1)).cuda()
         # for i in range(height*width):
@@ -237,53 +243,33 @@ class FullConvRes1(nn.Module):
 
         #energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         #pdb.set_trace()
-        max9 = max((1,9))  # 取top1准确率，若取top1和top9准确率改为max((1,9))
-        _, ReceptiveFieldIdex = energy.topk(max9, -1, True, False)
-
-        proj_query = x.view(m_batchsize,-1,height*width)
-        out = torch.zeros_like(proj_query).cuda()
-
-        ReceptiveField = torch.zeros_like(energy)
-        #x_out = torch.zeros_like(x_in)
-        for b in range(m_batchsize):
-            for t in range(height*width):
-                for k in range(9):
-                    #pdb.set_trace()
-                    ReceptiveField.data[b,t,ReceptiveFieldIdex[b,t,k]] = 1
-
-        for i in range(self.out_channels):
-            for j in range(height*width):
-                x_out = proj_query[ReceptiveField[:,j].unsqueeze(1).expand_as(proj_query)>0].view(m_batchsize,C,-1)
-                #x_out,_ = x_in.topk(max9, -1, True, False) # The shape of x_in:B X C X 9
-                x_K = torch.sum(x_out*(self.weight[i].expand_as(x_out)), dim=1)
-                out.data[:,i,j] = torch.sum(x_K, dim=1)+self.bias[i]
-        out = self.relu(out.view(m_batchsize,C,height,width))
-        # for i in range(self.out_channels):
-        #     for j in range(height*width):
-        #         #x_in = x_in[ReceptiveField[:,j,:].unsqueeze(1).expand_as(x_in).long()]
-        #         #pdb.set_trace()
-        #         x_in = x_in*(ReceptiveField[:,j].unsqueeze(1).expand_as(x_in))
-        #         x_out,_ = x_in.topk(max9, -1, True, False) # The shape of x_in:B X C X 9
-        #         x_9 = torch.sum(x_out*(self.weight[i].expand_as(x_out)), dim=1)
-        #         out.data[:,i,j] = torch.sum(x_9, dim=1)
-        # out = self.relu(out.view(m_batchsize,C,height,width))
+        _, ReceptiveFieldIdex = energy.topk(self.weight.size(-1), -1, True, False)
+        ReceptiveFieldIdex = torch.sort(ReceptiveFieldIdex, dim=-1)[0]
+
+        proj_query = x.reshape(m_batchsize,-1,height*width)
+        out = receptive_field_conv(proj_query, ReceptiveFieldIdex, self.weight, self.bias)
+        out = self.relu(out.reshape(m_batchsize, self.out_channels, height, width))
 
         return self.gamma * out + x
 
 class FullConv(nn.Module):
     """ Full Receptive Field Conv2d Block"""
-    def __init__(self, out_channels=64, in_channels=64, kernel_size=3):
+    def __init__(self, out_channels=64, in_channels=64, kernel_size=3, loss_type='cos', chunk_size=1024):
         super(FullConv, self).__init__()
 
 
-        self.dis = Dis('cos', batchsize=16)
+        self.dis = Dis(loss_type)
         self.out_channels = out_channels
+        # 每次只计算chunk_size行的相似度矩阵（chunk_size X HW），显存不随HW平方增长
+        # None表示一次算完整个HW X HW
+        self.chunk_size = chunk_size
         #self.gamma = nn.Parameter(torch.zeros(1))
         #self.energy1 =  torch.zeros((4, 11, 11)).cuda()
         self.softmax  = nn.Softmax(dim=-1)
         self.weight = nn.Parameter(
             torch.Tensor(out_channels, in_channels, kernel_size*kernel_size)
         )
+        init.xavier_uniform(self.weight)
         self.relu = nn.ReLU(True)
     def forward(self,x):
         """
@@ -297,30 +283,28 @@ class FullConv(nn.Module):
             
         """
         m_batchsize, C, height, width = x.size()
-        energy1 = torch.zeros((m_batchsize, height*width, height*width)).cuda()
-        proj_query = x.view(m_batchsize, C, -1).permute(0, 2, 1)
-        proj_key = x.view(m_batchsize, C, -1)
-        energy2 = torch.bmm(proj_query, proj_key)
-        for i in range(height*width):
-            for j in range(i,height*width):
-                #pdb.set_trace()
-                energy1.data[:,i,j] = self.dis(proj_query[:,i],proj_query[:,j])
-                energy1.data[:,j,i] = energy1.data[:,i,j]
-        
-        energy = energy1*energy2
+        proj_query = x.reshape(m_batchsize, C, -1).permute(0, 2, 1)
+        proj_key = x.reshape(m_batchsize, C, -1)
+        maxk = self.weight.size(-1)
+        chunk_size = self.chunk_size or height*width
+
+        top9, ReceptiveField = [], []
+        for i in range(0, height*width, chunk_size):
+            query = proj_query[:, i:i + chunk_size]
+            energy1 = self.dis.pairwise(query, proj_query)
+            energy2 = torch.bmm(query, proj_key)
+            energy = energy1*energy2
+            #energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
+            _top9, _ReceptiveField = energy.topk(maxk, -1, True, False)
+            top9.append(_top9)
+            ReceptiveField.append(_ReceptiveField)
+        top9 = torch.cat(top9, 1)
+        ReceptiveField = torch.cat(ReceptiveField, 1)
 
-        #energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
-        maxk = max((1,9))  # 取top1准确率，若取top1和top9准确率改为max((1,9))
-        top9, ReceptiveField = energy.topk(maxk, -1, True, False)
         top9 = top9*ReceptiveField
         score = self.softmax(top9)
-        x_in = x.view(m_batchsize,-1,height*width)
-        out = x_in
-        for i in range(self.out_channels):
-            for j in range(height*width):
-                x_in = x_in[:,:,ReceptiveField[:,j,:]]*score[:,j,:] # The shape of x:B X C X 9
-                out[:,i,j] = torch.sum(x_in*self.weight[i].expand_as(x), dim=0)
-        out = self.relu(out.view(m_batchsize,C,height,width))
+        out = receptive_field_conv(proj_key, ReceptiveField, self.weight, score=score)
+        out = self.relu(out.reshape(m_batchsize, self.out_channels, height, width))
 
         return out
 
@@ -1,5 +1,5 @@
-# from model import common
-import common
+from model import common
+# import common
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
@@ -38,8 +38,6 @@ class Dis(nn.Module):
         super(Dis, self).__init__()
         self.loss_type = loss_type
         #self.loss = torch.zeros(B)
-        if self.loss_type == 'cos':
-            self.dot_product, self.square_sum_x, self.square_sum_y = torch.zeros(B), torch.zeros(B), torch.zeros(B)
 
 
     def forward(self, x1, x2):
@@ -53,6 +51,25 @@ class Dis(nn.Module):
         if self.loss_type=='cos':
             return self.cosine_similarity(x1, x2)
 
+    def pairwise(self, x1, x2):
+        """
+            inputs :
+                x1 : B X N1 X C
+                x2 : B X N2 X C
+            returns :
+                out : B X N1 X N2, out[:,i,j] == self.forward(x1[:,i], x2[:,j])
+        """
+        if self.loss_type=='L1':
+            return torch.cdist(x1, x2, p=1)
+
+        if self.loss_type=='L2':
+            return torch.cdist(x1, x2, p=2).pow(2)
+
+        if self.loss_type=='cos':
+            x1 = x1 / x1.norm(dim=-1, keepdim=True)
+            x2 = x2 / x2.norm(dim=-1, keepdim=True)
+            return 0.5 * torch.bmm(x1, x2.permute(0, 2, 1)) + 0.5
+
 
     def L1Loss(self, x1, x2):
 
@@ -80,11 +97,10 @@ class Dis(nn.Module):
         # cos = self.bit_product_sum(x, y) / (torch.sqrt(self.bit_product_sum(x, x)) * torch.sqrt(self.bit_product_sum(y, y)))
 
         #method 3
-        dot_product, square_sum_x, square_sum_y = self.dot_product, self.square_sum_x, self.square_sum_y
-        for i in range(x.size()[1]):
-            dot_product[:] += x[:,i] * y[:,i]
-            square_sum_x[:] += x[:,i] * x[:,i]
-            square_sum_y[:] += y[:,i] * y[:,i]
+        # 原先在__init__中预分配的cpu缓冲区上逐个分量累加，缓冲区不清零，跨调用会累积；改为每次重新求和
+        dot_product = torch.sum(x * y, dim=1)
+        square_sum_x = torch.sum(x * x, dim=1)
+        square_sum_y = torch.sum(y * y, dim=1)
         cos = dot_product / (torch.sqrt(square_sum_x) * torch.sqrt(square_sum_y))
 
         return 0.5 * cos + 0.5 if norm else cos  # 归一化到[0, 1]区间内
@@ -107,18 +123,18 @@ class DAM_Module(nn.Module):
                 attention: B X N X N
         """
         m_batchsize, N, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, N, -1)
+        proj_key = x.reshape(m_batchsize, N, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
+        proj_value = x.reshape(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
+        out = out.reshape(m_batchsize, N, C, height, width)
 
         out = self.gamma*out + x
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         return out
 
 class SEDAM_Module(nn.Module):
@@ -148,26 +164,25 @@ class SEDAM_Module(nn.Module):
         # proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
         # energy = torch.bmm(proj_query, proj_key)
         # energy = self.conv_du(energy.view(m_batchsize, -1, 1, 1)).view(m_batchsize, N, N)
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, N, -1)
+        proj_key = x.reshape(m_batchsize, N, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
-        energy1 = torch.zeros((m_batchsize, N, 1)).cuda()
-        for i in range(N):
-            energy1.data[:,i] = torch.sqrt(energy[:,i,i]).unsqueeze(1)
+        # 对角线即各行向量的平方范数；与原先写入.data一致，范数不回传梯度
+        energy1 = torch.sqrt(torch.diagonal(energy, dim1=1, dim2=2)).unsqueeze(2).detach()
         energy2 = energy1.permute(0, 2, 1)
         energy = energy/energy1.expand_as(energy)
         energy = energy/energy2.expand_as(energy)
-        energy = self.conv_du(energy.view(m_batchsize, -1, 1, 1)).view(m_batchsize, N, N)
+        energy = self.conv_du(energy.reshape(m_batchsize, -1, 1, 1)).reshape(m_batchsize, N, N)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
 
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
+        proj_value = x.reshape(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
+        out = out.reshape(m_batchsize, N, C, height, width)
 
         out = self.gamma*out + x
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         return out
 
 class MSAM_Module(nn.Module):
@@ -204,17 +219,17 @@ class MSAM_Module(nn.Module):
         m_batchsize, C, height, width = x.size()
         x1 = self.multi_scale(x)
 
-        proj_query = x1.view(m_batchsize, -1, C*height*width//16)
-        proj_key = x1.view(m_batchsize, -1, C*height*width//16).permute(0, 2, 1)
+        proj_query = x1.reshape(m_batchsize, -1, C*height*width//16)
+        proj_key = x1.reshape(m_batchsize, -1, C*height*width//16).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
         #energy = self.conv_du(energy.view(m_batchsize, -1, 1, 1)).view(m_batchsize, H*W, H*W)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
 
         attention = self.softmax(energy_new)
-        proj_value = x1.view(m_batchsize, -1, C*height*width//16)
+        proj_value = x1.reshape(m_batchsize, -1, C*height*width//16)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         out = self.last_conv(out)
 
         out = self.gamma*out + x
@@ -280,12 +295,10 @@ class SAM_Module(nn.Module):
         x,top,left = self.depixel_shuffle(x)
         m_batchsize, C, height, width = x.size()
 
-        proj_query = x.view(m_batchsize, -1, height*width)
-        proj_key = x.view(m_batchsize, -1, height*width).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, -1, height*width)
+        proj_key = x.reshape(m_batchsize, -1, height*width).permute(0, 2, 1)
         energy = torch.bmm(proj_key, proj_query)
-        energy1 = torch.zeros((m_batchsize, height*width, 1)).cuda()
-        for i in range(height*width):
-            energy1.data[:,i] = torch.sqrt(energy[:,i,i]).unsqueeze(1)
+        energy1 = torch.sqrt(torch.diagonal(energy, dim1=1, dim2=2)).unsqueeze(2).detach()
         energy = energy/energy1.expand_as(energy)
         energy1 = energy1.permute(0, 2, 1)
         #energy = energy/energy1.expand_as(energy)
@@ -298,7 +311,7 @@ class SAM_Module(nn.Module):
         #proj_value = x.view(m_batchsize, -1, height*width)
 
         out = torch.bmm(proj_query, energy.permute(0, 2, 1))
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         #atten = self.conv0(x)
 
 
@@ -313,7 +326,6 @@ class SAM_Module(nn.Module):
 
     def depixel_shuffle(self, x, upscale_factor=2):    
         batch_size, channels, height, width = x.size()
-        pdb.set_trace()
         out_channels = channels * (upscale_factor ** 2)              
         top,left = 0,0
         if height%2==1:
@@ -326,11 +338,11 @@ class SAM_Module(nn.Module):
         height = math.ceil(height / upscale_factor)
         width = math.ceil(width / upscale_factor)
 
-        x_view = x.contiguous().view(
+        x_view = x.reshape(
             batch_size, channels, height, upscale_factor, width, upscale_factor)
 
         shuffle_out = x_view.permute(0, 1, 3, 5, 2, 4).contiguous()
-        return shuffle_out.view(batch_size, out_channels, height, width),top,left
+        return shuffle_out.reshape(batch_size, out_channels, height, width),top,left
         
     def squaremax(self, x, dim=-1):
         x_square = x.pow(2)
@@ -372,28 +384,25 @@ class SECAM_Module(nn.Module):
                 attention: B X C X C
         """
         m_batchsize, C, height, width = x.size()
-        pdb.set_trace()
 
         # proj_query = x.view(m_batchsize, C, -1)
         # proj_key = x.view(m_batchsize, C, -1).permute(0, 2, 1)
         # energy = torch.bmm(proj_query, proj_key)
-        proj_query = x.contiguous().view(m_batchsize, C, -1)
-        proj_key = x.contiguous().view(m_batchsize, C, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, C, -1)
+        proj_key = x.reshape(m_batchsize, C, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
-        energy1 = torch.zeros((m_batchsize, C, 1)).cuda()
-        for i in range(C):
-            energy1.data[:,i] = torch.sqrt(energy[:,i,i]).unsqueeze(1)
+        energy1 = torch.sqrt(torch.diagonal(energy, dim1=1, dim2=2)).unsqueeze(2).detach()
         energy2 = energy1.permute(0, 2, 1)
         energy = energy/energy1.expand_as(energy)
         energy = energy/energy2.expand_as(energy)
-        energy = self.conv_du(energy.view(m_batchsize, -1, 1, 1)).view(m_batchsize, C, C)
+        energy = self.conv_du(energy.reshape(m_batchsize, -1, 1, 1)).reshape(m_batchsize, C, C)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
 
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, C, -1)
+        proj_value = x.reshape(m_batchsize, C, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
 
         out = self.gamma*out + x
         #out = out.view(m_batchsize, -1, height, width)
@@ -426,33 +435,26 @@ class LAM_Module(nn.Module):
             
         """
         m_batchsize, N, C, height, width = x.size()
-        energy1 = torch.zeros((4, 11, 11)).cuda()
 
         #energy2 = Variable(energy1,requires_grad=True)
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, N, -1)
+        proj_key = x.reshape(m_batchsize, N, -1).permute(0, 2, 1)
         energy2 = torch.bmm(proj_query, proj_key)
-        for i in range(N):
-                #a = []
-            for j in range(i,N):
-                #pdb.set_trace()
-                #a.append(self.dis(proj_query[:][i],proj_query[:][j]))
-                energy1.data[:,i,j] = self.dis(proj_query[:,i],proj_query[:,j])
-
-                energy1.data[:,j,i] = energy1.data[:,i,j]
-            #energy1.append(a)
+        # 任意两层特征的距离一次算出（B X N X N，在x所在的设备上），代替逐对循环和固定形状的cuda缓冲区
+        # 与原先写入.data一致，距离不回传梯度
+        energy1 = self.dis.pairwise(proj_query, proj_query).detach()
         
         energy = energy1*energy2
 
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
+        proj_value = x.reshape(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
+        out = out.reshape(m_batchsize, N, C, height, width)
 
         out = self.gamma*out + x
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         return out
         
         
@@ -491,7 +493,7 @@ class GAM_Module(nn.Module):
         # out = out.view(m_batchsize, N, C, height, width)
 
         out = self.gamma*out
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         x = x * out + x
         return x
 
@@ -43,18 +43,18 @@ class DAM_Module(nn.Module):
                 attention: B X N X N
         """
         m_batchsize, N, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, N, -1)
-        proj_key = x.view(m_batchsize, N, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, N, -1)
+        proj_key = x.reshape(m_batchsize, N, -1).permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
         energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)-energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, N, -1)
+        proj_value = x.reshape(m_batchsize, N, -1)
 
         out = torch.bmm(attention, proj_value)
-        out = out.view(m_batchsize, N, C, height, width)
+        out = out.reshape(m_batchsize, N, C, height, width)
 
         out = self.gamma*out + x
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         return out
 
 class GAM_Module(nn.Module):
@@ -92,7 +92,7 @@ class GAM_Module(nn.Module):
         # out = out.view(m_batchsize, N, C, height, width)
 
         out = self.gamma*out
-        out = out.view(m_batchsize, -1, height, width)
+        out = out.reshape(m_batchsize, -1, height, width)
         x = x * out + x
         return x
 
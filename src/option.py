@@ -1,3 +1,4 @@
+import os
 import argparse
 import template
 
@@ -15,8 +16,21 @@ parser.add_argument('--cpu', action='store_true',
                     help='use cpu only')
 parser.add_argument('--n_GPUs', type=int, default=1,
                     help='number of GPUs')
+parser.add_argument('--gpu_ids', type=str, default='',
+                    help='visible GPU ids, e.g. 0,1 (empty keeps CUDA_VISIBLE_DEVICES)')
 parser.add_argument('--seed', type=int, default=1,
                     help='random seed')
+parser.add_argument('--channels_last', action='store_true',
+                    help='use channels_last (NHWC) memory format, cudnn/oneDNN kernels')
+parser.add_argument('--cudnn_benchmark', action='store_true',
+                    help='autotune cudnn kernels for fixed-size training patches')
+parser.add_argument('--dist_backend', type=str, default='',
+                    help='DDP backend (gloo | nccl), default: gloo for --cpu, nccl otherwise')
+parser.add_argument('--compile', action='store_true',
+                    help='torch.compile the network and the L1/MSE loss (single GPU / cpu)')
+parser.add_argument('--compile_mode', type=str, default='default',
+                    choices=('default', 'reduce-overhead', 'max-autotune'),
+                    help='torch.compile mode')
 
 # Data specifications
 # 我的添加：dat文件
@@ -59,6 +73,8 @@ parser.add_argument('--chop', action='store_true',
                     help='enable memory-efficient forward')
 parser.add_argument('--no_augment', action='store_true',
                     help='do not use data augmentation')
+parser.add_argument('--no_prefetch', action='store_true',
+                    help='do not prefetch batches (side cuda stream / background thread)')
 
 # Model specifications
 parser.add_argument('--model', default='MatrixModel',
@@ -120,6 +136,15 @@ parser.add_argument('--self_ensemble', action='store_true',
                     help='use self-ensemble method for test')
 parser.add_argument('--test_only', action='store_true',
                     help='set this option to test the model')
+parser.add_argument('--no_fuse', action='store_true',
+                    help='do not fuse Conv+BN/MeanShift for --test_only')
+parser.add_argument('--quantize', action='store_true',
+                    help='also test a post-training int8 model on cpu (EDSR | RCAN | HAN)')
+parser.add_argument('--calib_batches', type=int, default=4,
+                    help='number of training batches for int8 calibration')
+parser.add_argument('--quant_backend', type=str, default='fbgemm',
+                    choices=('fbgemm', 'x86', 'qnnpack'),
+                    help='quantized engine for int8 inference')
 parser.add_argument('--gan_k', type=int, default=1,
                     help='k value for adversarial loss')
 
@@ -143,12 +168,22 @@ parser.add_argument('--weight_decay', type=float, default=0,
                     help='weight decay')
 parser.add_argument('--gclip', type=float, default=0,
                     help='gradient clipping threshold (0 = no clipping)')
+parser.add_argument('--ema_decay', type=float, default=0,
+                    help='keep an EMA of the weights with this decay, saved as model_ema.pt (0 = off)')
+parser.add_argument('--ema_every', type=int, default=10,
+                    help='update the EMA every N steps (decay is compounded accordingly)')
+parser.add_argument('--ema_eval', action='store_true',
+                    help='evaluate with the EMA weights in Trainer.test (model_best.pt then holds the EMA weights)')
 
 # Loss specification
 parser.add_argument('--loss', type=str, default='1*MSE',
-                    help='loss function configuration')
+                    help='loss function configuration, e.g. 1*L1+0.005*RGAN-patch (GAN discriminator: -patch / -global)')
 parser.add_argument('--skip_threshold', type=float, default='1e8',
                     help='skipping batch that has large error')
+parser.add_argument('--vgg_weights', type=str, default='',
+                    help='local vgg19 weights for VGG loss (empty: download from torchvision)')
+parser.add_argument('--vgg_half', action='store_true',
+                    help='compute VGG features in fp16 (cuda)')
 
 # Log specifications
 # parser.add_argument('--save', type=str, default='test',
@@ -158,7 +193,8 @@ parser.add_argument('--save', type=str, default='',
 parser.add_argument('--save_suffix', type=str, default='',
                     help='file name to save')
 parser.add_argument('--load', type=str, default='',
-                    help='file name to load')
+                    help='file name to load (resumes from model/checkpoint.pt; '
+                         'loss.pt and optimizer.pt are no longer written, older experiments still load them)')
 """
 在modle文件夹的，init.py中的load函数中使用
 -1 : latest_modle.pt
@@ -167,15 +203,41 @@ else : model_~.pt 区别于resume=-1
 """
 parser.add_argument('--resume', type=int, default=0,
                     help='resume from specific checkpoint')
+parser.add_argument('--verify_checkpoint', action='store_true',
+                    help='check the sha256 of model/checkpoint.pt before resuming')
 parser.add_argument('--save_models', action='store_true',
                     help='save all intermediate models')
 parser.add_argument('--print_every', type=int, default=100,
                     help='how many batches to wait before logging training status')
+parser.add_argument('--plot_interval', type=float, default=60,
+                    help='minimum seconds between redrawing PSNR/loss plots (0 = every epoch)')
 parser.add_argument('--save_results', action='store_true',
                     help='save output results')
 parser.add_argument('--save_gt', action='store_true',
                     help='save low-resolution and high-resolution images together')
 
+# Export specifications（export.py使用）
+parser.add_argument('--export_format', type=str, default='torchscript',
+                    help='export formats, e.g. torchscript+onnx')
+parser.add_argument('--export_size', type=str, default='48+48',
+                    help='LR input size (H+W) used for tracing')
+parser.add_argument('--dynamic_axes', action='store_true',
+                    help='export with dynamic batch/height/width')
+parser.add_argument('--opset', type=int, default=11,
+                    help='ONNX opset version')
+parser.add_argument('--export_runs', type=int, default=10,
+                    help='number of runs for the CPU latency comparison')
+
+# Server specifications（server.py使用）
+parser.add_argument('--host', type=str, default='127.0.0.1',
+                    help='address the inference server listens on')
+parser.add_argument('--port', type=int, default=8000,
+                    help='port of the inference server')
+parser.add_argument('--max_batch', type=int, default=8,
+                    help='maximum number of same-size requests batched together')
+parser.add_argument('--max_latency', type=float, default=10,
+                    help='maximum time (ms) a request waits for a batch to fill')
+
 args = parser.parse_args()
 template.set_template(args)
 
@@ -186,6 +248,12 @@ args.data_test = args.data_test.split('+')
 if args.epochs == 0:
     args.epochs = 1e8
 
+# DDP：进程信息由torchrun或launch.py通过环境变量传入，单进程时world_size=1
+args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+args.rank = int(os.environ.get('RANK', 0))
+args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+args.distributed = args.world_size > 1
+
 # 将输入的字符串True，转化为bool值True
 for arg in vars(args):
     if vars(args)[arg] == 'True':
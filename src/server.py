@@ -0,0 +1,240 @@
+"""
+本地推理服务：模型只加载一次，通过HTTP接收图像或dat切片，返回超分辨率结果
+默认只监听127.0.0.1
+
+用法（在src目录下运行）：
+python server.py --template HAN --scale 2 --n_colors 1 --chop \
+    --pre_train ../experiment/xxx/model/model_best.pt --port 8000
+
+接口：
+POST /sr                 请求体为图像文件（png等），返回png
+POST /sr_dat?h=H&w=W     请求体为一个dat切片（uint8，H x W），返回uint8的SR切片（响应头X-Height、X-Width）
+GET  /stats              请求数、batch数、平均batch大小、p50/p99延迟（ms）、吞吐量（请求/秒）
+
+动态batch：第一个请求到达后最多等待--max_latency毫秒，期间到达的同尺寸请求合并成一个batch
+（最多--max_batch个），尺寸不同的请求留到下一个batch
+网络的调用与main.py --test_only相同（Model.forward）：--chop时使用forward_chop分块，
+--self_ensemble时使用forward_x8；--test_only下的Conv+BN/MeanShift合并同样生效
+"""
+import json
+import time
+import queue
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from option import args
+
+import numpy as np
+import imageio
+import torch
+
+import utility
+import model
+from data import common
+
+class Request():
+    def __init__(self, lr):
+        self.lr = lr
+        self.t0 = time.time()
+        self.done = threading.Event()
+        self.sr = None
+        self.error = None
+
+class Stats():
+    """延迟保留最近window个请求；吞吐量为最近60秒内完成的请求数 / 时间"""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.finished = deque()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.t_start = time.time()
+
+    def record(self, latencies):
+        now = time.time()
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.finished.extend([now] * len(latencies))
+            while self.finished and now - self.finished[0] > 60:
+                self.finished.popleft()
+            self.n_requests += len(latencies)
+            self.n_batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            now = time.time()
+            span = min(60, now - self.t_start)
+            recent = sum(1 for t in self.finished if now - t <= 60)
+            return {
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'mean_batch': self.n_requests / max(self.n_batches, 1),
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'throughput': recent / max(span, 1e-8),
+                'uptime': now - self.t_start
+            }
+
+class Batcher():
+    def __init__(self, net, stats, max_batch=8, max_latency=10):
+        """
+        inputs :
+            net : model.Model，eval模式
+            max_latency : 合并batch时最多等待的时间（毫秒），从第一个请求到达时开始计算
+        """
+        self.net = net
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_latency = max_latency / 1000
+        self.device = torch.device('cpu' if args.cpu else 'cuda')
+        self.queue = queue.Queue()
+        # 尺寸与当前batch不同、留到下一个batch的请求
+        self.pending = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, lr):
+        # 在HTTP处理线程中调用，等待结果（cpu上的 c x H x W 张量）
+        r = Request(lr)
+        self.queue.put(r)
+        r.done.wait()
+        if r.error is not None: raise r.error
+        return r.sr
+
+    def _next_batch(self):
+        first = self.pending.pop(0) if self.pending else self.queue.get()
+        batch = [first]
+        for r in list(self.pending):
+            if len(batch) >= self.max_batch: break
+            if r.lr.shape == first.lr.shape:
+                batch.append(r)
+                self.pending.remove(r)
+
+        deadline = first.t0 + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0: break
+            try:
+                r = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if r.lr.shape == first.lr.shape:
+                batch.append(r)
+            else:
+                self.pending.append(r)
+
+        return batch
+
+    def _prepare(self, lr):
+        lr = lr.to(self.device, non_blocking=True)
+        if args.precision == 'half': lr = lr.half()
+        if args.channels_last: lr = lr.contiguous(memory_format=torch.channels_last)
+        return lr
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                lr = self._prepare(torch.stack([r.lr for r in batch]))
+                # 梯度开关是线程局部的，在这个线程中关闭
+                with torch.no_grad():
+                    sr = self.net(lr, 0)
+                sr = utility.quantize(sr, args.rgb_range).float().cpu()
+                for r, s in zip(batch, sr):
+                    r.sr = s
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+
+            self.stats.record([time.time() - r.t0 for r in batch])
+            for r in batch:
+                r.done.set()
+
+def to_tensor(img):
+    img, = common.set_channel(img, n_channels=args.n_colors)
+    lr, = common.np2Tensor(img, rgb_range=args.rgb_range)
+    return lr
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *a):
+        # 不逐个请求打印访问日志
+        pass
+
+    def _send(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/stats':
+            self._send_json(200, self.server.stats.summary())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if url.path == '/sr':
+                img = imageio.imread(body)
+                sr = self.server.batcher.submit(to_tensor(img))
+                # 与checkpoint.save_results相同：转换到0~255
+                out = sr.mul(255 / args.rgb_range).byte().permute(1, 2, 0).numpy()
+                if out.shape[2] == 1: out = out[:, :, 0]
+                self._send(200, imageio.imwrite('<bytes>', out, format='png'), 'image/png')
+            elif url.path == '/sr_dat':
+                query = parse_qs(url.query)
+                h, w = int(query['h'][0]), int(query['w'][0])
+                lr = np.frombuffer(body, dtype=np.uint8).reshape(h, w)
+                sr = self.server.batcher.submit(to_tensor(lr))
+                # 与Trainer.test中写入sr_dat相同：第一个通道直接转换为uint8
+                out = sr[0].numpy().astype(np.uint8)
+                self._send(200, out.tobytes(), 'application/octet-stream',
+                           {'X-Height': out.shape[0], 'X-Width': out.shape[1]})
+            else:
+                self._send_json(404, {'error': 'not found'})
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+
+def main():
+    # 与--test_only相同：只推理，不建立训练数据和loss，模型做推理化简
+    args.test_only = True
+    ckp = utility.checkpoint(args)
+    net = model.Model(args, ckp)
+    if not args.no_fuse:
+        # 没有测试集，在一个随机的48x48输入上校验、计时
+        x = torch.rand(1, args.n_colors, 48, 48) * args.rgb_range
+        net.fuse(ckp, [('48x48', x)], args.rgb_range)
+    net.eval()
+
+    stats = Stats()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.stats = stats
+    server.batcher = Batcher(net, stats, max_batch=args.max_batch, max_latency=args.max_latency)
+    ckp.write_log('Serving {} x{} on http://{}:{} (max batch {}, max latency {}ms)'.format(
+        args.model, args.scale[0], args.host, args.port, args.max_batch, args.max_latency))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ckp.write_log(json.dumps(stats.summary()))
+        ckp.done()
+
+if __name__ == '__main__':
+    main()
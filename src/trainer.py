@@ -3,14 +3,14 @@ import math
 from decimal import Decimal
 
 import utility
+from data import prefetcher
+from model.ema import EMA
 
 import torch
 import torch.nn.utils as utils
 from tqdm import tqdm
 import numpy as np
 import pdb
-from skimage.metrics import peak_signal_noise_ratio
-from skimage.metrics import structural_similarity
 
 
 class Trainer():
@@ -26,10 +26,32 @@ class Trainer():
         self.optimizer = utility.make_optimizer(args, self.model)
 
         if self.args.load != '':
-            self.optimizer.load(ckp.dir, epoch=len(ckp.log))
+            self.optimizer.load(ckp.dir, epoch=ckp.last_epoch(), state=ckp.load_state())
             #print('aaaaaaaaaaaaaaaaaaaaaaaaaaaaa')
+        # Model、Loss、optimizer都已加载，释放checkpoint.pt的mmap
+        ckp.release_state()
+
+        # EMA权重（--ema_decay > 0），续训时从model_ema.pt恢复
+        self.ema = None
+        if args.ema_decay > 0 and not args.test_only:
+            self.ema = EMA(self.model.model, decay=args.ema_decay, every=args.ema_every)
+            path_ema = ckp.get_path('model', 'model_ema.pt')
+            if self.args.load != '' and os.path.exists(path_ema):
+                self.ema.load_state_dict(utility.load_checkpoint(path_ema))
+
+        # 只做测试时，合并Conv+BN、MeanShift（模型不会再被训练和保存），
+        # 在各测试集的第一张图像上校验，并记录合并前后的推理时间
+        if args.test_only and not args.no_fuse:
+            inputs = []
+            for d in self.loader_test:
+                d.dataset.set_scale(0)
+                inputs.append((d.dataset.name, next(iter(d))[0]))
+            self.model.fuse(ckp, inputs, args.rgb_range)
 
         self.error_last = 1e8
+        self.device = torch.device('cpu' if args.cpu else 'cuda')
+        # 最近一次test的结果：(idx_data, idx_scale) -> (psnr, 前向时间)
+        self.test_stats = {}
 
     def train(self):
         self.loss.step()
@@ -48,6 +70,8 @@ class Trainer():
         开启train模式
         """
         self.model.train()
+        # 训练patch尺寸固定，cudnn自动选择最快的卷积算法
+        torch.backends.cudnn.benchmark = self.args.cudnn_benchmark
         timer_data, timer_model = utility.timer(), utility.timer()
         """
         TEMP
@@ -55,13 +79,15 @@ class Trainer():
         如何实现多scale处理，还是不清楚
         """
         self.loader_train.dataset.set_scale(0)
+        # DDP：每个epoch重新划分各进程的数据
+        if hasattr(self.loader_train.sampler, 'set_epoch'):
+            self.loader_train.sampler.set_epoch(epoch)
 
         """
         enumerate(self.loader_train)
         ？调用dataset的getitem()
         """
-        for batch, (lr, hr, _,) in enumerate(self.loader_train):
-            lr, hr = self.prepare(lr, hr)
+        for batch, (lr, hr, _,) in enumerate(self.prefetch(self.loader_train)):
             timer_data.hold()
             timer_model.tic()
 
@@ -88,6 +114,7 @@ class Trainer():
                     self.args.gclip
                 )
             self.optimizer.step()
+            if self.ema is not None: self.ema.update()
 
             timer_model.hold()
 
@@ -95,18 +122,22 @@ class Trainer():
             print_every(_batch)
             """
             if (batch + 1) % self.args.print_every == 0:
-                self.ckp.write_log('[{}/{}]\t{}\t{:.1f}+{:.1f}s'.format(
+                t_model = timer_model.release()
+                # VGG loss占模型（前向+反向+更新）时间的比例
+                t_vgg = self.loss.vgg_time()
+                self.ckp.write_log('[{}/{}]\t{}\t{:.1f}+{:.1f}s{}'.format(
                     (batch + 1) * self.args.batch_size,
                     # 出现错误，应该是三维像素矩阵的第三维，而不是所有像素点的数目
                     len(self.loader_train.dataset),
                     self.loss.display_loss(batch),
-                    timer_model.release(),
-                    timer_data.release()))
+                    t_model,
+                    timer_data.release(),
+                    '' if t_vgg is None else '\tVGG: {:.0f}%'.format(100 * t_vgg / max(t_model, 1e-8))))
 
             timer_data.tic()
 
         self.loss.end_log(len(self.loader_train))
-        self.error_last = self.loss.log[-1, -1]
+        self.error_last = self.loss.log[-1][-1]
         self.optimizer.schedule()
 
     def test(self):
@@ -115,10 +146,13 @@ class Trainer():
         epoch = self.optimizer.get_last_epoch()
         #print(epoch)
         self.ckp.write_log('\nEvaluation:')
-        self.ckp.add_log(
-            torch.zeros(1, len(self.loader_test), len(self.scale))
-        )
+        is_best = False
         self.model.eval()
+        # --ema_eval：用EMA权重测试，保存模型之前换回
+        use_ema = self.ema is not None and self.args.ema_eval
+        if use_ema: self.ema.swap()
+        # benchmark数据集的图像尺寸各不相同，每个新尺寸都会重新autotune，只对尺寸固定的dat切片开启
+        torch.backends.cudnn.benchmark = self.args.cudnn_benchmark and self.args.dat
 
         timer_test = utility.timer()
 
@@ -133,14 +167,15 @@ class Trainer():
                 if self.args.dat:
                     sr_dat = np.zeros((self.args.nx_test, self.args.ny_test, self.args.nz_test), dtype=np.uint8)
                 # psnr、ssim数据记录
+                psnr_sum = 0
                 calc_psnr_mean = 0
                 psnr_mean = 0
                 ssim_mean = 0
                 # 计数
                 num = 0
+                timer_set = utility.timer()
                 # 从dataset中，获取图像
-                for lr, hr, filename in tqdm(d, ncols=80):
-                    lr, hr = self.prepare(lr, hr)
+                for lr, hr, filename in tqdm(self.prefetch(d), total=len(d), ncols=80, disable=not self.ckp.is_main):
                     sr = self.model(lr, idx_scale)
                     sr = utility.quantize(sr, self.args.rgb_range)
 
@@ -160,7 +195,7 @@ class Trainer():
                     # if self.args.save_results:
                     #     self.ckp.save_results(d, filename[0], save_list, scale)
 
-                    self.ckp.log[-1, idx_data, idx_scale] += utility.calc_psnr(
+                    psnr_sum += utility.calc_psnr(
                         sr, hr, scale, self.args.rgb_range, dataset=d
                     )
 
@@ -179,25 +214,37 @@ class Trainer():
                     # self.ckp.writer.add_scalar(r'calc_psnr', calc_psnr, (epoch+1)*len(d) + num)
                     # self.ckp.writer.add_scalar(r'psnr', psnr.item(), (epoch+1)*len(d) + num)
                     # self.ckp.writer.add_scalar(r'ssim', ssim.item(), (epoch+1)*len(d) + num)
+                # DDP：对各进程的psnr之和、图像数求和，所有进程得到相同的平均值
+                psnr_sum, calc_psnr_mean, num = utility.all_reduce_sum(
+                    [psnr_sum, calc_psnr_mean, num],
+                    device=self.device
+                )
                 # tensorboard
-                calc_psnr_mean /= len(d)
+                calc_psnr_mean /= num
                 # psnr_mean /= len(d)
                 # ssim_mean /= len(d)
-                self.ckp.writer.add_scalar(r'calc_psnr_mean', calc_psnr_mean, epoch + 1)
+                if self.ckp.is_main:
+                    self.ckp.writer.add_scalar(r'calc_psnr_mean', calc_psnr_mean, epoch + 1)
                 # self.ckp.writer.add_scalar(r'psnr_mean', psnr_mean.item(), epoch + 1)
                 # self.ckp.writer.add_scalar(r'ssim_mean', ssim_mean.item(), epoch + 1)
                 if self.args.save_results:
                     if self.args.dat:
+                        # DDP：各进程只填写了自己的切片，汇总成一个dat体数据
+                        sr_dat = utility.reduce_array_sum(sr_dat, device=self.device)
                         self.ckp.save_results_dat(d, sr_dat, scale)
-                self.ckp.log[-1, idx_data, idx_scale] /= len(d)
-                best = self.ckp.log.max(0)
+                psnr = psnr_sum / num
+                self.test_stats[(idx_data, idx_scale)] = (psnr, timer_set.toc())
+                # 追加到metrics.jsonl，best为运行中的最大值
+                best = self.ckp.add_psnr(epoch, self.args.data_test[idx_data], scale, psnr)
+                if idx_data == 0 and idx_scale == 0:
+                    is_best = best[1] == epoch
                 self.ckp.write_log(
                     '[{} x{}]\tPSNR: {:.3f} (Best: {:.3f} @epoch {})'.format(
                         d.dataset.name,
                         scale,
-                        self.ckp.log[-1, idx_data, idx_scale],
-                        best[0][idx_data, idx_scale],
-                        best[1][idx_data, idx_scale]
+                        psnr,
+                        best[0],
+                        best[1]
                     )
                 )
 
@@ -207,9 +254,11 @@ class Trainer():
         if self.args.save_results:
             self.ckp.end_background()
 
+        if use_ema: self.ema.swap()
+
         # 保存test效果最好的模型
         if not self.args.test_only:
-            self.ckp.save(self, epoch, is_best=(best[1][0, 0] == epoch))
+            self.ckp.save(self, epoch, is_best=is_best)
 
         self.ckp.write_log(
             'Total: {:.2f}s\n'.format(timer_test.toc()), refresh=True
@@ -217,6 +266,49 @@ class Trainer():
 
         torch.set_grad_enabled(True)
 
+    def quantize(self):
+        """
+        训练后静态int8量化：用calib_batches个训练batch校准，
+        保存量化模型model_int8.pt（TorchScript），并替换self.model.model用于之后的test
+        """
+        from model import quantize
+
+        if not self.args.cpu:
+            raise ValueError('--quantize runs int8 inference on cpu, use it with --cpu')
+        if self.args.model not in quantize.supported:
+            self.ckp.write_log('Warning: int8 quantization of {} is not tested'.format(self.args.model))
+
+        self.loader_train.dataset.set_scale(0)
+        batches = []
+        for lr, _, _ in self.loader_train:
+            batches.append(self.prepare(lr)[0])
+            if len(batches) >= self.args.calib_batches: break
+
+        prepared = quantize.prepare(self.model.model, batches[0], backend=self.args.quant_backend)
+        quantize.calibrate(prepared, batches)
+        self.model.model = quantize.convert(prepared)
+        self.model.set_forward()
+        quantize.save(self.model.model, batches[0], self.ckp.get_path('model', 'model_int8.pt'))
+        self.ckp.write_log('int8 model calibrated on {} batches, saved to {}'.format(
+            len(batches), self.ckp.get_path('model', 'model_int8.pt')))
+
+    def test_quantized(self):
+        # float结果与int8结果并列写入log；test()会覆盖self.test_stats中的结果，先复制一份
+        float_stats = dict(self.test_stats)
+        self.quantize()
+        self.test()
+        self.ckp.write_log('int8 vs float:')
+        for idx_data, d in enumerate(self.loader_test):
+            for idx_scale, scale in enumerate(self.scale):
+                psnr_f, t_f = float_stats[(idx_data, idx_scale)]
+                psnr_q, t_q = self.test_stats[(idx_data, idx_scale)]
+                self.ckp.write_log(
+                    '[{} x{}]\tPSNR: {:.3f} -> {:.3f} (drop {:.3f})\tTime: {:.2f}s -> {:.2f}s ({:.2f}x)'.format(
+                        d.dataset.name, scale, psnr_f, psnr_q, psnr_f - psnr_q,
+                        t_f, t_q, t_f / max(t_q, 1e-8)
+                    ), refresh=True
+                )
+
     def prepare(self, *args):
         """
         将输入张量，改变精度，映射到计算设备上
@@ -224,12 +316,24 @@ class Trainer():
         :param args:
         :return:
         """
-        device = torch.device('cpu' if self.args.cpu else 'cuda')
-        def _prepare(tensor):
-            if self.args.precision == 'half': tensor = tensor.half()
-            return tensor.to(device)
+        return [self.prepare_tensor(a) for a in args]
+
+    def prepare_tensor(self, tensor):
+        # pin_memory的张量non_blocking拷贝，与计算重叠；先拷贝再转half，在gpu上转换
+        tensor = tensor.to(self.device, non_blocking=True)
+        if self.args.precision == 'half': tensor = tensor.half()
+        if self.args.channels_last and tensor.dim() == 4:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
 
-        return [_prepare(a) for a in args]
+    def prefetch(self, loader):
+        """
+        预取下一个batch（见data/prefetcher.py），返回的lr、hr已经prepare过
+        --no_prefetch时与原来一样，在循环中同步prepare
+        """
+        if self.args.no_prefetch:
+            return ((*self.prepare(lr, hr), rest) for lr, hr, rest in loader)
+        return prefetcher.prefetch(loader, self.prepare_tensor, cuda=not self.args.cpu)
 
     def terminate(self):
         '''
@@ -241,6 +345,8 @@ class Trainer():
         if self.args.test_only:
             # test_only:true时，在此处执行模型test
             self.test()
+            if self.args.quantize:
+                self.test_quantized()
             return True
         else:
             epoch = self.optimizer.get_last_epoch() + 1
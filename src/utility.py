@@ -1,23 +1,22 @@
 import os
+import json
 import math
+import shutil
+import hashlib
 import time
 import datetime
+import threading
+import queue as queue_module
+from collections import OrderedDict
 from multiprocessing import Process
 from multiprocessing import Queue
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
 import numpy as np
 import imageio
 
 import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as lrs
-from torch.utils.tensorboard import SummaryWriter
-
-from skimage.metrics import peak_signal_noise_ratio
 
 class timer():
     def __init__(self):
@@ -45,19 +44,291 @@ class timer():
     def reset(self):
         self.acc = 0
 
+# 分布式（DDP）辅助函数：没有初始化进程组时，都退化为单进程的行为
+def init_distributed(args):
+    """
+    torchrun / launch.py启动时初始化进程组
+    每个进程只使用一个设备：gpu为local_rank对应的卡，cpu时使用gloo后端
+    """
+    if not args.distributed: return
+
+    import torch.distributed as dist
+    backend = args.dist_backend or ('gloo' if args.cpu else 'nccl')
+    if not args.cpu:
+        torch.cuda.set_device(args.local_rank)
+    dist.init_process_group(backend=backend, init_method='env://')
+    args.n_GPUs = 1
+    # cpu进程之间平分核数，避免线程过多互相抢占
+    if args.cpu:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+
+def get_rank():
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+def all_reduce_sum(values, device=None):
+    """
+    对各进程的一组数值求和，返回list
+    nccl只支持gpu张量，所以device与模型所在设备一致
+    """
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return list(values)
+
+    t = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+    return t.tolist()
+
+def all_reduce_mean_(tensors):
+    """
+    各进程的一组张量原地取平均（如不经过DDP的梯度），拼接成一个张量只通信一次
+    """
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()) or not tensors:
+        return
+
+    from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+    flat = _flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for t, s in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        t.copy_(s)
+
+def broadcast_tensors_(tensors):
+    # 以rank 0的值为准，原地覆盖（如不经过DDP的模块的初始参数）
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return
+
+    for t in tensors:
+        dist.broadcast(t, src=0)
+
+def reduce_array_sum(array, device=None):
+    """
+    把各进程的numpy数组求和到rank 0（如各进程只填写了自己切片的dat体数据）
+    返回值只在rank 0上有效
+    """
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return array
+
+    t = torch.from_numpy(array).to(device)
+    dist.reduce(t, dst=0)
+    return t.cpu().numpy()
+
+def broadcast_object(obj):
+    # 以rank 0的值为准，如实验目录名
+    import torch.distributed as dist
+    if not (dist.is_available() and dist.is_initialized()):
+        return obj
+
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
+
+def snapshot(obj):
+    """
+    把state_dict（可以嵌套dict/list）中的张量拷贝到cpu
+    之后训练继续原地修改参数，也不会影响后台正在写入的内容
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().cpu() if obj.is_cuda else obj.detach().clone()
+    if isinstance(obj, dict):
+        out = OrderedDict((k, snapshot(v)) for k, v in obj.items())
+        # Module.state_dict的版本信息（如BatchNorm），load_state_dict时使用
+        if hasattr(obj, '_metadata'): out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def save_atomic(obj, *paths):
+    """
+    先写临时文件再rename：中途崩溃时，原来的文件保持完整，不会留下写了一半的checkpoint
+    写入多个文件时只序列化一次，其余文件从第一个临时文件拷贝
+    """
+    tmps = [path + '.tmp' for path in paths]
+    torch.save(obj, tmps[0])
+    for tmp in tmps[1:]:
+        shutil.copyfile(tmps[0], tmp)
+    for tmp, path in zip(tmps, paths):
+        os.replace(tmp, path)
+
+def file_sha256(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def save_checkpoint(state, path):
+    """
+    续训用的checkpoint：model、optimizer、scheduler、loss的state_dict保存在一个文件中
+    torch的zip格式中每个张量是单独的记录（文件末尾有索引），可以mmap按需读取
+    文件的sha256、大小、各部分的条目数记录在<path>.json中
+    """
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    index = {
+        'version': state['version'],
+        'epoch': state['epoch'],
+        'sha256': file_sha256(tmp),
+        'size': os.path.getsize(tmp),
+        'sections': {k: len(v) for k, v in state.items() if isinstance(v, dict)}
+    }
+    os.replace(tmp, path)
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + '.json.tmp', path + '.json')
+
+def verify_checkpoint(path):
+    with open(path + '.json') as f:
+        index = json.load(f)
+    if file_sha256(path) != index['sha256']:
+        raise RuntimeError('Checkpoint {} does not match its recorded sha256'.format(path))
+
+def load_checkpoint(path):
+    """
+    torch>=2.1时mmap加载：张量在load_state_dict拷贝到目标设备时才从文件读取，
+    不会先把整个文件读进内存；旧版本torch或旧格式文件退回普通加载
+    统一先放在cpu上，由load_state_dict拷贝到参数所在的设备
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location='cpu')
+
+class BackgroundWriter():
+    """
+    checkpoint的后台写线程：按提交顺序执行torch.save、绘图等I/O
+    save()在调用线程中先做cpu快照，只把写文件放到后台
+    后台任务的异常在下一次submit/wait时抛出
+    队列最多maxsize个任务：写文件跟不上时submit阻塞，等待排队的任务完成，
+    排队的cpu快照（每个都是一份完整的模型/优化器状态）不会无限增加
+    """
+    def __init__(self, maxsize=8):
+        self.queue = queue_module.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None: return
+                fn, args = job
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args):
+        self._check()
+        self.queue.put((fn, args))
+
+    def save(self, obj, *paths):
+        # 同一份快照可以写入多个文件（如model_latest.pt和model_best.pt）
+        self.submit(save_atomic, snapshot(obj), *paths)
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+class MetricsLog():
+    """
+    追加写入的指标记录（JSONL），每行一条记录：
+        {"epoch": 3, "data": "Set5", "scale": 2, "psnr": 32.1}
+        {"epoch": 3, "loss": "L1", "value": 0.0123}
+    每个epoch只追加几行，不再重写全部历史；续训时顺序读一遍
+    resume为False时（新实验）清空原有记录，与原来重新建立psnr_log.pt一致
+    """
+    def __init__(self, path, write=True, resume=True):
+        self.path = path
+        self.records = []
+        self.file = None
+        if resume and os.path.exists(path):
+            good = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        # 写到一半时崩溃留下的残行，丢弃
+                        break
+                    good += len(line)
+            if write and good < os.path.getsize(path):
+                os.truncate(path, good)
+        if write:
+            self.file = open(path, 'a' if resume else 'w')
+
+    def truncate(self, epoch):
+        """
+        丢弃epoch之后的记录：这些epoch的checkpoint.pt没有写完，续训时重新训练
+        可写时先写临时文件再rename，重写metrics.jsonl
+        """
+        records = [r for r in self.records if r['epoch'] <= epoch]
+        if len(records) == len(self.records): return
+        self.records[:] = records
+        if self.file is None: return
+        self.file.close()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'a')
+
+    def append(self, records):
+        self.records.extend(records)
+        if self.file is None: return
+        for r in records:
+            self.file.write(json.dumps(r) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None: self.file.close()
+
 class checkpoint():
     # 函数组1
     def __init__(self, args):
         self.args = args
         self.ok = True
-        # log：模型参数文件psnr_log.pt，每个epoch都要记录
-        self.log = torch.Tensor()
-        now = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+        # DDP时只有rank 0写文件（目录、log、模型），其他进程只读取
+        self.is_main = is_main_process()
+        # psnr记录：(数据集, scale) -> ([epoch], [psnr])；best：(数据集, scale) -> (psnr, epoch)
+        self.psnr = {}
+        self.best = {}
+        # 续训时model/checkpoint.pt的内容（mmap），各模块加载完后释放
+        self.state = None
+        # 各进程的时间可能相差一秒，以rank 0为准，保证实验目录一致
+        now = broadcast_object(datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S'))
 
         # 加载checkpoint
         # load：加载load中的数据，继续上一次训练
         # dir：某次实验的文件根目录
-        # log：psnr_log.pt
+        # metrics.jsonl：每个epoch的psnr、loss
         if not args.load:
             # 新的实验，建立对应实验根目录
             if not args.save:
@@ -69,16 +340,24 @@ class checkpoint():
         else:
             # 加载已存在实验数据，加载对应实验根目录
             self.dir = os.path.join('..', 'experiment', args.load)
-            if os.path.exists(self.dir):
-                self.log = torch.load(self.get_path('psnr_log.pt'))
-                print('Continue from epoch {}...'.format(len(self.log)))
-            else:
+            if not os.path.exists(self.dir):
                 args.load = ''
 
         # reset：重置实验，删除实验根目录
         if args.reset:
-            os.system('rm -rf ' + self.dir)
+            if self.is_main: os.system('rm -rf ' + self.dir)
             args.load = ''
+        barrier()
+
+        if not self.is_main:
+            self.log_file = open(os.devnull, 'w')
+            self._writer = None
+            self.bg_writer = None
+            self.n_processes = max(1, 8 // args.world_size)
+            # 等待rank 0建立目录（各进程的测试结果写入同一个results目录）
+            barrier()
+            self.load_metrics(write=False)
+            return
 
         # 建立dir，如果dir没有建立
         os.makedirs(self.dir, exist_ok=True)
@@ -87,9 +366,9 @@ class checkpoint():
         # 建立数据集sr重建结果输出文件夹
         for d in args.data_test:
             os.makedirs(self.get_path('results-{}'.format(d)), exist_ok=True)
-        # 建立tensorboard文件夹与对应writer
+        # 建立tensorboard文件夹，writer在第一次使用时创建
         os.makedirs(self.get_path('tblog'), exist_ok=True)
-        self.writer = SummaryWriter(log_dir=self.get_path('tblog'))
+        self._writer = None
 
         # log_file，加载log.txt：model结构
         # w：打开文件，具有写权限
@@ -103,8 +382,82 @@ class checkpoint():
                 f.write('{}: {}\n'.format(arg, getattr(args, arg)))
             f.write('\n')
 
-        # 线程数（background函数中将使用线程）
-        self.n_processes = 8
+        # 线程数（background函数中将使用线程），DDP时各进程平分
+        self.n_processes = max(1, 8 // args.world_size)
+        # 模型、loss、optimizer的保存和绘图在后台线程中进行，不阻塞训练
+        self.bg_writer = BackgroundWriter()
+        self.last_plot = None
+        # test_only不改变实验的指标记录
+        self.load_metrics(write=not args.test_only)
+        barrier()
+
+    def load_metrics(self, write=True):
+        """
+        读取metrics.jsonl，重建各数据集、scale的psnr曲线和best
+        旧实验只有psnr_log.pt时，转换一次
+        """
+        resume = bool(self.args.load)
+        self.metrics = MetricsLog(self.get_path('metrics.jsonl'), write=write, resume=resume)
+        records = self.metrics.records
+        if resume and not any('psnr' in r for r in records) \
+                and os.path.exists(self.get_path('psnr_log.pt')):
+            log = torch.load(self.get_path('psnr_log.pt'))
+            self.metrics.append([
+                {'epoch': i + 1, 'data': d, 'scale': scale,
+                 'psnr': log[i, idx_data, idx_scale].item()}
+                for i in range(len(log))
+                for idx_data, d in enumerate(self.args.data_test)
+                for idx_scale, scale in enumerate(self.args.scale)
+            ])
+
+        # 续训以checkpoint.pt的epoch为准：metrics.jsonl每个epoch立即写入，checkpoint.pt由后台线程稍后写入，
+        # 两者之间崩溃时丢弃之后的记录，psnr曲线、best、Loss.log与恢复的模型、optimizer一致
+        self.resume_epoch = None
+        state = self.load_state() if resume else None
+        if state is not None:
+            self.resume_epoch = state['epoch']
+            self.metrics.truncate(self.resume_epoch)
+
+        for r in records:
+            if 'psnr' in r: self._update_psnr(r)
+        if resume:
+            print('Continue from epoch {}...'.format(self.last_epoch()))
+
+    def _update_psnr(self, r):
+        key = (r['data'], r['scale'])
+        epochs, values = self.psnr.setdefault(key, ([], []))
+        epochs.append(r['epoch'])
+        values.append(r['psnr'])
+        if key not in self.best or r['psnr'] > self.best[key][0]:
+            self.best[key] = (r['psnr'], r['epoch'])
+
+    def load_state(self):
+        """
+        续训（--load）时读取model/checkpoint.pt，只打开一次，Model、Loss、optimizer共用
+        旧实验没有这个文件时返回None，各模块读取原来的model_latest.pt、loss.pt、optimizer.pt
+        """
+        path = self.get_path('model', 'checkpoint.pt')
+        if self.state is None and self.args.load and os.path.exists(path):
+            if self.args.verify_checkpoint: verify_checkpoint(path)
+            self.state = load_checkpoint(path)
+            print('Open checkpoint.pt (epoch {})'.format(self.state['epoch']))
+        return self.state
+
+    def release_state(self):
+        self.state = None
+
+    def last_epoch(self):
+        # 已记录的最后一个epoch，续训时optimizer从这里继续
+        # 有checkpoint.pt时不小于其中的epoch（记录已按它截断）
+        return max([r['epoch'] for r in self.metrics.records] + [self.resume_epoch or 0])
+
+    @property
+    def writer(self):
+        # tensorboard导入较慢，推迟到第一次写入时
+        if self._writer is None:
+            from torch.utils.tensorboard import SummaryWriter
+            self._writer = SummaryWriter(log_dir=self.get_path('tblog'))
+        return self._writer
 
     def get_path(self, *subdir):
         '''
@@ -124,48 +477,74 @@ class checkpoint():
         :param is_best:
         :return:
         """
-        # 保存best、latest、epoch_i模型权重文件
-        trainer.model.save(self.get_path('model'), epoch, is_best=is_best)
-        # 保存loss模块权重文件loss.pt，和每个epoch的平均loss记录文件loss_log.pt
-        trainer.loss.save(self.dir)
-
-        # 绘制并保存loss图像
-        trainer.loss.plot_loss(self.dir, epoch)
-        # 绘制并保存psnr图像
-        self.plot_psnr(epoch)
-
-        trainer.optimizer.save(self.dir)
-        torch.save(self.log, self.get_path('psnr_log.pt'))
+        if not self.is_main: return
+        writer = self.bg_writer
+        # 续训所需的全部状态写入一个文件model/checkpoint.pt（代替loss.pt、optimizer.pt）
+        # scheduler的状态直接保存，续训时不再逐个epoch调用scheduler.step()
+        # 每个epoch的psnr、loss已经追加到metrics.jsonl
+        state = {
+            'version': 1,
+            'epoch': epoch,
+            'model': trainer.model.model.state_dict(),
+            'optimizer': trainer.optimizer.state_dict(),
+            'scheduler': trainer.optimizer.scheduler.state_dict(),
+            'loss': trainer.loss.state_dict()
+        }
+        state = snapshot(state)
+        writer.submit(save_checkpoint, state, self.get_path('model', 'checkpoint.pt'))
+        # 模型权重仍单独保存model_latest.pt、best、epoch_i（--pre_train使用），
+        # 与checkpoint.pt共用同一份cpu快照
+        # --ema_eval时best是EMA权重的测试结果，model_best.pt保存EMA权重
+        ema_best = trainer.ema is not None and self.args.ema_eval
+        trainer.model.save(
+            self.get_path('model'), epoch, is_best=is_best and not ema_best,
+            writer=writer, state_dict=state['model']
+        )
+        if trainer.ema is not None:
+            paths = [self.get_path('model', 'model_ema.pt')]
+            if is_best and ema_best:
+                paths.append(self.get_path('model', 'model_best.pt'))
+            writer.save(trainer.ema.state_dict(), *paths)
+
+        # 绘图限速：距上次绘图不足plot_interval秒时跳过，最后一个epoch总是绘制
+        now = time.time()
+        last = epoch >= self.args.epochs
+        if last or self.last_plot is None or now - self.last_plot >= self.args.plot_interval:
+            self.last_plot = now
+            # 绘制并保存loss图像
+            trainer.loss.plot_loss(self.dir, epoch, writer=writer)
+            # 绘制并保存psnr图像
+            self.plot_psnr(epoch)
 
     def plot_psnr(self, epoch):
-        axis = np.linspace(1, epoch, epoch)
         # 仅对测试数据集，绘制psnr图像
-        for idx_data, d in enumerate(self.args.data_test):
-            label = 'SR on {}'.format(d)
-            fig = plt.figure()
-            plt.title(label)
-            for idx_scale, scale in enumerate(self.args.scale):
-                plt.plot(
-                    axis,
-                    self.log[:, idx_data, idx_scale].numpy(),
-                    label='Scale {}'.format(scale)
-                )
-            plt.legend()
-            plt.xlabel('Epochs')
-            plt.ylabel('PSNR')
-            plt.grid(True)
-            plt.savefig(self.get_path('test_{}.png'.format(d)))
-            plt.close(fig)
+        for d in self.args.data_test:
+            curves = [
+                ('Scale {}'.format(scale), *map(list, self.psnr.get((d, scale), ([], []))))
+                for scale in self.args.scale
+            ]
+            self.bg_writer.submit(
+                plot_curves, self.get_path('test_{}.png'.format(d)),
+                'SR on {}'.format(d), curves, 'PSNR'
+            )
 
     # 函数组3
-    def add_log(self, log):
-        # 拼接log（psnr）：将传入的log与ckp中log拼接
-        # log(psnr)最终由skp.save函数保存
-        self.log = torch.cat([self.log, log])
+    def add_psnr(self, epoch, data, scale, psnr):
+        """
+        追加一条psnr记录（立即写入metrics.jsonl）
+        returns :
+            (best psnr, best epoch)，由运行中的最大值得到，不再对全部历史求max
+        """
+        r = {'epoch': epoch, 'data': data, 'scale': scale, 'psnr': psnr}
+        self.metrics.append([r])
+        self._update_psnr(r)
+
+        return self.best[(data, scale)]
 
     # 函数组4
     def write_log(self, log, refresh=False):
         # 往log.txt中写入日志
+        if not self.is_main: return
         print(log)
         self.log_file.write(log + '\n')
         if refresh:
@@ -173,6 +552,9 @@ class checkpoint():
             self.log_file = open(self.get_path('log.txt'), 'a')
 
     def done(self):
+        # 等待后台的checkpoint写入完成
+        if self.bg_writer is not None: self.bg_writer.close()
+        self.metrics.close()
         self.log_file.close()
 
     # 函数组5
@@ -236,13 +618,39 @@ class checkpoint():
                 self.queue.put(('{}{}.png'.format(filename, p), tensor_cpu))
 
     def save_results_dat(self, dataset, sr_dat, scale):
-        if self.args.save_results:
+        # DDP：sr_dat已经由trainer汇总到rank 0
+        if self.args.save_results and self.is_main:
             filename = self.get_path(
                 'results-{}'.format(dataset.dataset.name),
                 '{}_x{}_SR.DAT'.format(self.args.data_test, scale)
             )
             sr_dat.tofile(filename)
 
+def get_pyplot():
+    # matplotlib只在绘图时导入
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def plot_curves(path, title, curves, ylabel):
+    """
+    inputs :
+        curves : [(label, epochs, values)]，每条曲线的x、y值
+    在BackgroundWriter的线程中调用，pyplot只在这个线程中使用
+    """
+    plt = get_pyplot()
+    fig = plt.figure()
+    plt.title(title)
+    for label, x, y in curves:
+        plt.plot(x, y, label=label)
+    plt.legend()
+    plt.xlabel('Epochs')
+    plt.ylabel(ylabel)
+    plt.grid(True)
+    plt.savefig(path)
+    plt.close(fig)
+
 def quantize(img, rgb_range):
     """
     :param img:
@@ -285,6 +693,7 @@ def calc_psnr(sr, hr, scale, rgb_range, dataset=None):
     valid = diff[..., shave:-shave, shave:-shave]
     mse = valid.pow(2).mean()
 
+    from skimage.metrics import peak_signal_noise_ratio
     print(f"\npeak_signal_noise_ratio : {peak_signal_noise_ratio(hr.cpu().numpy(), sr.cpu().numpy(), data_range=rgb_range)}")
     print(f"calc_psnr : {-10 * math.log10(mse)}")
 
@@ -293,6 +702,22 @@ def calc_psnr(sr, hr, scale, rgb_range, dataset=None):
 # def calc_psnr(sr, hr, scale, rgb_range, dataset=None):
 #     return peak_signal_noise_ratio(hr, sr, data_range=rgb_range)
 
+def measure_latency(fn, x, runs=10, warmup=2):
+    """
+    测量fn(x)的推理时间（秒），取runs次的中位数
+    cuda上的计时会先同步，避免只测到kernel的提交时间
+    """
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            if x.is_cuda: torch.cuda.synchronize()
+            t0 = time.time()
+            fn(x)
+            if x.is_cuda: torch.cuda.synchronize()
+            if i >= warmup: times.append(time.time() - t0)
+
+    return float(np.median(times))
+
 def make_optimizer(args, target):
     '''
         make optimizer and scheduler together
@@ -333,10 +758,18 @@ def make_optimizer(args, target):
         def _register_scheduler(self, scheduler_class, **kwargs):
             self.scheduler = scheduler_class(self, **kwargs)
 
-        def save(self, save_dir):
-            torch.save(self.state_dict(), self.get_dir(save_dir))
-
-        def load(self, load_dir, epoch=1):
+        def save(self, save_dir, writer=None):
+            if writer is None:
+                save_atomic(self.state_dict(), self.get_dir(save_dir))
+            else:
+                writer.save(self.state_dict(), self.get_dir(save_dir))
+
+        def load(self, load_dir, epoch=1, state=None):
+            # state：checkpoint.pt的内容，scheduler的状态直接恢复
+            if state is not None:
+                self.load_state_dict(state['optimizer'])
+                self.scheduler.load_state_dict(state['scheduler'])
+                return
             self.load_state_dict(torch.load(self.get_dir(load_dir)))
             if epoch > 1:
                 for _ in range(epoch): self.scheduler.step()
@@ -0,0 +1,102 @@
+"""
+纯PyTorch的DeformConv / ModulatedDeformConv（grid_sample实现）与逐点循环的参考实现比较
+（pytest test/test_deform_conv.py，或直接python运行）
+
+参考实现按CUDA kernel（deformable_im2col）的公式逐个输出位置、卷积核位置计算：
+    p = p0 + p_k + offset_k，在p处双线性插值，超出输入范围的角点取0，
+    (h_im <= -1 或 h_im >= height 时整个采样为0)，再乘以mask，与weight求和
+"""
+import os
+import sys
+import math
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from model.dcn.deform_conv import deform_conv, modulated_deform_conv
+
+def bilinear(img, y, x):
+    C, H, W = img.size()
+    val = img.new_zeros(C)
+    if y <= -1 or y >= H or x <= -1 or x >= W:
+        return val
+    y0, x0 = math.floor(y), math.floor(x)
+    for yy, wy in ((y0, 1 - (y - y0)), (y0 + 1, y - y0)):
+        for xx, wx in ((x0, 1 - (x - x0)), (x0 + 1, x - x0)):
+            if 0 <= yy < H and 0 <= xx < W:
+                val = val + wy * wx * img[:, yy, xx]
+    return val
+
+def deform_conv_loop(input, offset, mask, weight, bias, stride, padding, dilation, groups, dg):
+    N, C, H, W = input.size()
+    O, Cg, kh, kw = weight.size()
+    K = kh * kw
+    ho, wo = offset.shape[2:]
+    out = input.new_zeros(N, O, ho, wo)
+    for n in range(N):
+        for oy in range(ho):
+            for ox in range(wo):
+                # columns: C X K
+                columns = input.new_zeros(C, K)
+                for i in range(kh):
+                    for j in range(kw):
+                        k = i * kw + j
+                        for g in range(dg):
+                            dy = offset[n, g * 2 * K + 2 * k, oy, ox].item()
+                            dx = offset[n, g * 2 * K + 2 * k + 1, oy, ox].item()
+                            y = oy * stride - padding + i * dilation + dy
+                            x = ox * stride - padding + j * dilation + dx
+                            m = 1 if mask is None else mask[n, g * K + k, oy, ox]
+                            c0, c1 = g * C // dg, (g + 1) * C // dg
+                            columns[c0:c1, k] = bilinear(input[n, c0:c1], y, x) * m
+                for o in range(O):
+                    g = o // (O // groups)
+                    cols = columns[g * Cg:(g + 1) * Cg]
+                    out[n, o, oy, ox] = (weight[o].view(Cg, K) * cols).sum()
+                    if bias is not None:
+                        out[n, o, oy, ox] += bias[o]
+    return out
+
+# (N, C, H, W, O, kernel, stride, padding, dilation, groups, deformable_groups)
+cases = [
+    (2, 4, 5, 6, 4, 3, 1, 1, 1, 1, 1),
+    (1, 4, 7, 5, 6, 3, 2, 1, 1, 2, 2),
+    (1, 2, 6, 6, 2, 3, 1, 2, 2, 1, 1),
+    # H或W为1：越界的采样点必须补0，而不是落到第0个像素
+    (1, 2, 1, 5, 3, 3, 1, 1, 1, 1, 1),
+    (1, 2, 4, 1, 3, 3, 1, 1, 1, 1, 1),
+]
+
+def _inputs(case, seed):
+    N, C, H, W, O, k, stride, padding, dilation, groups, dg = case
+    g = torch.Generator().manual_seed(seed)
+    ho = (H + 2 * padding - dilation * (k - 1) - 1) // stride + 1
+    wo = (W + 2 * padding - dilation * (k - 1) - 1) // stride + 1
+    input = torch.randn(N, C, H, W, generator=g, dtype=torch.float64)
+    # 偏移量较大，部分采样点落在输入之外
+    offset = 2 * torch.randn(N, dg * 2 * k * k, ho, wo, generator=g, dtype=torch.float64)
+    mask = torch.rand(N, dg * k * k, ho, wo, generator=g, dtype=torch.float64)
+    weight = torch.randn(O, C // groups, k, k, generator=g, dtype=torch.float64)
+    bias = torch.randn(O, generator=g, dtype=torch.float64)
+    return input, offset, mask, weight, bias
+
+def test_deform_conv():
+    for seed, case in enumerate(cases):
+        _, _, _, _, _, _, stride, padding, dilation, groups, dg = case
+        input, offset, _, weight, _ = _inputs(case, seed)
+        out = deform_conv(input, offset, weight, stride, padding, dilation, groups, dg)
+        ref = deform_conv_loop(input, offset, None, weight, None, stride, padding, dilation, groups, dg)
+        assert torch.allclose(out, ref), case
+
+def test_modulated_deform_conv():
+    for seed, case in enumerate(cases):
+        _, _, _, _, _, _, stride, padding, dilation, groups, dg = case
+        input, offset, mask, weight, bias = _inputs(case, seed)
+        out = modulated_deform_conv(input, offset, mask, weight, bias, stride, padding, dilation, groups, dg)
+        ref = deform_conv_loop(input, offset, mask, weight, bias, stride, padding, dilation, groups, dg)
+        assert torch.allclose(out, ref), case
+
+if __name__ == '__main__':
+    test_deform_conv()
+    test_modulated_deform_conv()
+    print('ok')
@@ -0,0 +1,176 @@
+"""
+rcan1.FullConv / FullConvRes / FullConvRes1 / Dis.pairwise与逐对循环版本的一致性
+（pytest test/test_fullconv.py，或直接python运行）
+
+FullConv的循环参考实现：
+1、energy1按原来的双重循环，逐对调用Dis.forward填充
+2、聚合按定义逐个输出通道、位置、感受野位置累加：
+   out[b,o,n] = sum_k score[b,n,k] * sum_c x[b,c,rf[b,n,k]] * weight[o,c,k]
+   （原循环中x_in被反复覆盖、weight[i].expand_as(x)的形状也不对，不能直接运行，这里按其本意展开）
+
+FullConvRes / FullConvRes1的循环参考实现与原来的代码相同（布尔掩码 + 逐个输出通道、位置循环），
+只是不再写入.data、结果用torch.stack拼接，这样也可以比较梯度
+"""
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from model import rcan1
+
+def fullconv_loop(m, x):
+    B, C, H, W = x.size()
+    N = H * W
+    x_flat = x.view(B, C, N)
+    proj_query = x_flat.permute(0, 2, 1)
+
+    energy1 = torch.zeros(B, N, N, dtype=x.dtype)
+    for i in range(N):
+        for j in range(i, N):
+            energy1[:, i, j] = m.dis(proj_query[:, i], proj_query[:, j])
+            energy1[:, j, i] = energy1[:, i, j]
+    energy = energy1 * torch.bmm(proj_query, x_flat)
+
+    K = m.weight.size(-1)
+    top9, rf = energy.topk(K, -1, True, False)
+    score = torch.softmax(top9 * rf, dim=-1)
+
+    out = torch.zeros(B, m.out_channels, N, dtype=x.dtype)
+    for b in range(B):
+        for o in range(m.out_channels):
+            for n in range(N):
+                for k in range(K):
+                    out[b, o, n] += score[b, n, k] * (x_flat[b, :, rf[b, n, k]] * m.weight[o, :, k]).sum()
+
+    return torch.relu(out.view(B, m.out_channels, H, W))
+
+def test_pairwise():
+    torch.manual_seed(0)
+    x1 = torch.randn(2, 5, 6, dtype=torch.float64)
+    x2 = torch.randn(2, 7, 6, dtype=torch.float64)
+    for loss_type in ('L1', 'L2', 'cos'):
+        dis = rcan1.Dis(loss_type)
+        out = dis.pairwise(x1, x2)
+        for i in range(x1.size(1)):
+            for j in range(x2.size(1)):
+                assert torch.allclose(out[:, i, j], dis(x1[:, i], x2[:, j])), loss_type
+
+def test_fullconv():
+    torch.manual_seed(0)
+    for loss_type in ('L1', 'L2', 'cos'):
+        m = rcan1.FullConv(out_channels=4, in_channels=3, loss_type=loss_type, chunk_size=None).double()
+        x = torch.randn(2, 3, 4, 5, dtype=torch.float64)
+        with torch.no_grad():
+            out = m(x)
+            ref = fullconv_loop(m, x)
+            # 分块计算与一次算完的结果相同
+            m.chunk_size = 7
+            out_chunk = m(x)
+        assert torch.allclose(out, ref), loss_type
+        assert torch.allclose(out_chunk, out), loss_type
+
+def _mask_conv_loop(m, proj_query, ReceptiveField):
+    # 原循环：按ReceptiveField的布尔掩码取出感受野（位置升序），逐个输出通道、位置求和
+    B, C, N = proj_query.size()
+    out = []
+    for i in range(m.out_channels):
+        row = []
+        for j in range(N):
+            x_out = proj_query[ReceptiveField[:, j].unsqueeze(1).expand_as(proj_query) > 0].view(B, C, -1)
+            x_K = torch.sum(x_out * (m.weight[i].expand_as(x_out)), dim=1)
+            row.append(torch.sum(x_K, dim=1) + m.bias[i])
+        out.append(torch.stack(row, dim=1))
+    return torch.stack(out, dim=1)
+
+def _mark(energy, index):
+    ReceptiveField = torch.zeros_like(energy)
+    B, N, K = index.size()
+    for b in range(B):
+        for t in range(N):
+            for k in range(K):
+                ReceptiveField[b, t, index[b, t, k]] = 1
+    return ReceptiveField
+
+def fullconvres_loop(m, x):
+    B, C, H, W = x.size()
+    N = H * W
+    proj_query = x.view(B, C, -1)
+    proj_key = x.view(B, C, -1).permute(0, 2, 1)
+    energy = torch.bmm(proj_key, proj_query)
+    energy1 = torch.zeros(B, N, 1, dtype=x.dtype)
+    for i in range(N):
+        energy1[:, i] = torch.sqrt(energy[:, i, i]).unsqueeze(1).detach()
+    energy2 = energy1.permute(0, 2, 1)
+    energy_new = energy / energy1.expand_as(energy)
+    energy_new = energy_new / energy2.expand_as(energy)
+
+    energy_new = torch.sort(energy_new, dim=-1)[1].float()
+    e = torch.chunk(energy_new, m.K, dim=-1)
+    index = torch.stack([e[i][:, :, 0] for i in range(m.K)], dim=2).long()
+
+    out = _mask_conv_loop(m, proj_query, _mark(energy, index))
+    out = torch.relu(out.view(B, m.out_channels, H, W))
+    return m.gamma * out + x
+
+def fullconvres1_loop(m, x):
+    B, C, H, W = x.size()
+    proj_query = m.query_conv(x).view(B, C // 8, -1)
+    proj_key = m.key_conv(x).view(B, C // 8, -1).permute(0, 2, 1)
+    energy = torch.bmm(proj_key, proj_query)
+    _, index = energy.topk(9, -1, True, False)
+
+    proj_query = x.view(B, -1, H * W)
+    out = _mask_conv_loop(m, proj_query, _mark(energy, index))
+    out = torch.relu(out.view(B, m.out_channels, H, W))
+    return m.gamma * out + x
+
+def _check_parity(m, loop, size):
+    # gamma初始为0时输出与x相同、weight没有梯度，这里设为非0
+    with torch.no_grad():
+        m.gamma.fill_(0.5)
+    x = torch.randn(2, m.weight.size(1), *size, dtype=torch.float64)
+    g = torch.randn(2, m.weight.size(1), *size, dtype=torch.float64)
+    grads = []
+    for fn in (m, lambda x: loop(m, x)):
+        m.zero_grad()
+        x_in = x.clone().requires_grad_(True)
+        out = fn(x_in)
+        (out * g).sum().backward()
+        grads.append((out.detach(), x_in.grad, m.weight.grad.clone(), m.bias.grad.clone(), m.gamma.grad.clone()))
+    for a, b in zip(*grads):
+        assert torch.allclose(a, b), size
+
+def test_chunk_starts():
+    # 总是k个位置；torch.chunk能分出k段时与每段的第一个位置相同
+    for n in range(9, 80):
+        starts = rcan1.chunk_starts(n, 9)
+        assert starts.tolist() == sorted(set(starts.tolist())) and len(starts) == 9, n
+        assert starts.max() < n, n
+        chunks = torch.chunk(torch.arange(n), 9)
+        if len(chunks) == 9:
+            assert starts.tolist() == [c[0].item() for c in chunks], n
+
+def test_fullconvres():
+    torch.manual_seed(0)
+    m = rcan1.FullConvRes(out_channels=4, in_channels=4, K=9).double()
+    # 5x5、3x6：HW不是K的整数倍（原循环可以运行的尺寸）
+    for size in ((5, 5), (3, 6)):
+        _check_parity(m, fullconvres_loop, size)
+    # 4x5：torch.chunk只有7段，原循环会越界；现在仍取9个位置
+    x = torch.randn(2, 4, 4, 5, dtype=torch.float64)
+    assert m(x).shape == x.shape
+
+def test_fullconvres1():
+    torch.manual_seed(0)
+    m = rcan1.FullConvRes1(out_channels=8, in_channels=8, kernel_size=3).double()
+    for size in ((4, 5), (3, 5)):
+        _check_parity(m, fullconvres1_loop, size)
+
+if __name__ == '__main__':
+    test_pairwise()
+    test_fullconv()
+    test_chunk_starts()
+    test_fullconvres()
+    test_fullconvres1()
+    print('ok')
@@ -0,0 +1,54 @@
+"""
+utility.MetricsLog.truncate：续训时丢弃checkpoint.pt之后的epoch的记录
+（pytest test/test_metrics.py，或直接python运行）
+"""
+import os
+import sys
+import json
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import utility
+
+def records(epochs):
+    out = []
+    for e in epochs:
+        out.append({'epoch': e, 'data': 'Set5', 'scale': 2, 'psnr': 30.0 + e})
+        out.append({'epoch': e, 'loss': 'L1', 'value': 1.0 / e})
+    return out
+
+def test_truncate():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'metrics.jsonl')
+        log = utility.MetricsLog(path, resume=False)
+        log.append(records([1, 2, 3]))
+        log.close()
+
+        # checkpoint.pt停在epoch 2：epoch 3的记录已写入metrics.jsonl
+        log = utility.MetricsLog(path, resume=True)
+        log.truncate(2)
+        assert log.records == records([1, 2])
+        # 重新训练epoch 3，不会出现重复的记录
+        log.append(records([3]))
+        log.close()
+        with open(path) as f:
+            assert [json.loads(line) for line in f] == records([1, 2, 3])
+
+def test_truncate_read_only():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'metrics.jsonl')
+        log = utility.MetricsLog(path, resume=False)
+        log.append(records([1, 2, 3]))
+        log.close()
+
+        # 不可写（DDP的其他进程、test_only）时只在内存中丢弃
+        log = utility.MetricsLog(path, write=False, resume=True)
+        log.truncate(1)
+        assert log.records == records([1])
+        with open(path) as f:
+            assert len(f.readlines()) == len(records([1, 2, 3]))
+
+if __name__ == '__main__':
+    test_truncate()
+    test_truncate_read_only()
+    print('ok')
@@ -0,0 +1,91 @@
+"""
+ops.EoctConv：stride=1的合并卷积实现（forward）与原实现（_forward_reference）的结果比较
+ops.OctaveBN：BatchNorm作为子模块注册，参数可以训练，running统计量随state_dict保存
+（pytest test/test_octave.py，或直接python运行）
+"""
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from model import ops
+from model import matrixmodel
+
+# (输入通道, 输出通道)，tuple表示(High, Low[, Lower])各频率的通道数
+configs = [
+    (4, (4, 3, 2)),
+    (4, (4, 3)),
+    ((4, 3), (4, 3)),
+    ((4, 3), (5, 2, 3)),
+    ((4, 3, 2), (4, 3, 2)),
+    ((4, 3, 2), (4, 3)),
+    ((4, 3, 2), 5),
+]
+
+def _input(in_channels, size=8):
+    if not isinstance(in_channels, tuple):
+        return torch.randn(2, in_channels, size, size, dtype=torch.float64)
+    return ops.Octave(
+        torch.randn(2, c, size // 2**i, size // 2**i, dtype=torch.float64)
+        for i, c in enumerate(in_channels)
+    )
+
+def _assert_close(out, ref):
+    if isinstance(ref, tuple):
+        assert isinstance(out, tuple) and len(out) == len(ref)
+        for o, r in zip(out, ref):
+            assert torch.allclose(o, r)
+    else:
+        assert torch.allclose(out, ref)
+
+def test_forward_matches_reference():
+    torch.manual_seed(0)
+    for in_channels, num_channels in configs:
+        conv = ops.EoctConv(in_channels, num_channels).double()
+        x = _input(in_channels)
+        # 训练（每次拼接权重）
+        _assert_close(conv(x), conv._forward_reference(x))
+        # 测试（缓存拼接后的权重）
+        with torch.no_grad():
+            _assert_close(conv(x), conv._forward_reference(x))
+            _assert_close(conv(x), conv._forward_reference(x))
+
+def test_cache_follows_parameter_updates():
+    torch.manual_seed(0)
+    conv = ops.EoctConv((4, 3, 2), (4, 3, 2)).double()
+    x = _input((4, 3, 2))
+    with torch.no_grad():
+        conv(x)
+        # 原地修改参数（如optimizer.step、load_state_dict）后缓存失效
+        for p in conv.parameters():
+            p.mul_(0.5)
+        _assert_close(conv(x), conv._forward_reference(x))
+
+def test_octave_bn():
+    torch.manual_seed(0)
+    bn = ops.OctaveBN((4, 3, 2)).double()
+    x = _input((4, 3, 2))
+    out = bn(x)
+    assert isinstance(out, ops.Octave) and len(out) == 3
+    # 每个频率一个BatchNorm2d，训练时更新running统计量
+    assert len(list(bn.parameters())) == 6
+    for m, d in zip(bn.bns, x):
+        assert torch.allclose(m.running_mean, 0.1 * d.mean((0, 2, 3)))
+    assert 'bns.2.running_var' in bn.state_dict()
+
+def test_eoct_res_block_bn():
+    block = matrixmodel.EoctResBlock((4, 3, 2), (4, 3, 2))
+    # 默认不加BN，state_dict与原来相同
+    assert not any('bn' in k for k in block.state_dict())
+    block = matrixmodel.EoctResBlock((4, 3, 2), (4, 3, 2), bn=True).double()
+    assert 'bn1.bns.0.weight' in block.state_dict() and 'bn2.bns.2.running_mean' in block.state_dict()
+    out = block(_input((4, 3, 2)))
+    assert [d.shape for d in out] == [d.shape for d in _input((4, 3, 2))]
+
+if __name__ == '__main__':
+    test_forward_matches_reference()
+    test_cache_follows_parameter_updates()
+    test_octave_bn()
+    test_eoct_res_block_bn()
+    print('ok')
@@ -0,0 +1,67 @@
+"""
+rcan3.Dis.pairwise / LAM_Module与原来逐对循环版本的一致性
+（pytest test/test_rcan3.py，或直接python运行）
+
+LAM_Module的循环参考实现与原来的代码相同（逐对调用Dis.forward填充energy1），
+只是energy1按输入的形状、设备创建，不再固定为(4, 11, 11)的cuda缓冲区
+"""
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from model import rcan3
+
+def lam_loop(m, x):
+    B, N, C, H, W = x.size()
+    energy1 = torch.zeros(B, N, N, dtype=x.dtype)
+    proj_query = x.view(B, N, -1)
+    proj_key = x.view(B, N, -1).permute(0, 2, 1)
+    energy2 = torch.bmm(proj_query, proj_key)
+    for i in range(N):
+        for j in range(i, N):
+            energy1.data[:, i, j] = m.dis(proj_query[:, i], proj_query[:, j])
+            energy1.data[:, j, i] = energy1.data[:, i, j]
+    energy = energy1 * energy2
+
+    energy_new = torch.max(energy, -1, keepdim=True)[0].expand_as(energy) - energy
+    attention = torch.softmax(energy_new, dim=-1)
+    out = torch.bmm(attention, x.view(B, N, -1)).view(B, N, C, H, W)
+    out = m.gamma * out + x
+    return out.view(B, -1, H, W)
+
+def test_pairwise():
+    torch.manual_seed(0)
+    x1 = torch.randn(2, 5, 6, dtype=torch.float64)
+    x2 = torch.randn(2, 7, 6, dtype=torch.float64)
+    for loss_type in ('L1', 'L2', 'cos'):
+        dis = rcan3.Dis(loss_type)
+        out = dis.pairwise(x1, x2)
+        for i in range(x1.size(1)):
+            for j in range(x2.size(1)):
+                assert torch.allclose(out[:, i, j], dis(x1[:, i], x2[:, j])), loss_type
+
+def test_cosine_does_not_accumulate():
+    # 原先的缓冲区跨调用累加，第二次调用的结果不同
+    torch.manual_seed(0)
+    dis = rcan3.Dis('cos')
+    x, y = torch.randn(4, 6, dtype=torch.float64), torch.randn(4, 6, dtype=torch.float64)
+    assert torch.allclose(dis(x, y), dis(x, y))
+
+def test_lam():
+    torch.manual_seed(0)
+    m = rcan3.LAM_Module(4).double()
+    with torch.no_grad():
+        m.gamma.fill_(0.5)
+    # 原来只能处理B=4、N=11的输入
+    for shape in ((2, 3, 4, 5, 5), (4, 11, 4, 3, 2)):
+        x = torch.randn(*shape, dtype=torch.float64)
+        with torch.no_grad():
+            assert torch.allclose(m(x), lam_loop(m, x)), shape
+
+if __name__ == '__main__':
+    test_pairwise()
+    test_cosine_does_not_accumulate()
+    test_lam()
+    print('ok')
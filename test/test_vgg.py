@@ -0,0 +1,57 @@
+"""
+loss.vgg.VGG：VGG22、VGG54共享一个trunk时，loss值、对sr的梯度与原来各自独立计算的结果相同
+（pytest test/test_vgg.py，或直接python运行）
+
+原来的计算：每个VGG loss各自建立vgg19的前8 / 35层，
+    loss = mse(vgg(sub_mean(sr)), vgg(sub_mean(hr)))
+权重使用随机初始化的vgg19，保存到临时文件后通过weights参数加载（不需要下载）
+"""
+import os
+import sys
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.models as models
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from model import common
+from loss import vgg
+
+def vgg_reference(features, depth, rgb_range, sr, hr):
+    net = nn.Sequential(*list(features)[:depth])
+    vgg_mean = (0.485, 0.456, 0.406)
+    vgg_std = (0.229 * rgb_range, 0.224 * rgb_range, 0.225 * rgb_range)
+    sub_mean = common.MeanShift(rgb_range, vgg_mean, vgg_std)
+    vgg_sr = net(sub_mean(sr))
+    with torch.no_grad():
+        vgg_hr = net(sub_mean(hr))
+    return F.mse_loss(vgg_sr, vgg_hr)
+
+def test_shared_trunk_matches_reference():
+    torch.manual_seed(0)
+    features = models.vgg19().features
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'vgg19_features.pt')
+        torch.save(features.state_dict(), path)
+        losses = [vgg.VGG('22', rgb_range=255, weights=path), vgg.VGG('54', rgb_range=255, weights=path)]
+
+    # 两个batch：第二个batch检查上一个batch的中间特征已经释放、不会被误用
+    for _ in range(2):
+        sr = (torch.rand(2, 3, 32, 32) * 255).requires_grad_(True)
+        hr = torch.rand(2, 3, 32, 32) * 255
+        out = [l(sr, hr) for l in losses]
+        grads = torch.autograd.grad(sum(out), sr)[0]
+
+        sr_ref = sr.detach().clone().requires_grad_(True)
+        ref = [vgg_reference(features, depth, 255, sr_ref, hr) for depth in (8, 35)]
+        grads_ref = torch.autograd.grad(sum(ref), sr_ref)[0]
+
+        for a, b in zip(out, ref):
+            assert torch.allclose(a, b, rtol=1e-5)
+        assert torch.allclose(grads, grads_ref, rtol=1e-4, atol=1e-6)
+
+if __name__ == '__main__':
+    test_shared_trunk_matches_reference()
+    print('ok')